@@ -0,0 +1,150 @@
+import os
+from numpy import *
+from scipy.cluster.vq import kmeans2
+
+import sift
+
+
+class DescriptorIndex(object):
+    """ Approximate nearest neighbor index for SIFT descriptors
+        (inverted file). Descriptors are clustered with k-means and
+        stored sorted by cluster, a query only compares against the
+        clusters closest to it. The index can be saved to a directory
+        and loaded back memory-mapped. """
+
+    files = ['centroids','desc','image','feature','offsets']
+
+    def __init__(self,centroids,desc,image,feature,offsets):
+        self.centroids = centroids # unit length cluster centers
+        self.desc = desc # normalized descriptors sorted by cluster
+        self.image = image # image number for each row of desc
+        self.feature = feature # feature number in that image
+        self.offsets = offsets # rows of cluster c are offsets[c]:offsets[c+1]
+
+    @staticmethod
+    def build(desclist,nbr_lists=None,iter=10,nbr_train=100000,seed=0):
+        """ Build an index from a list of descriptor arrays, one per
+            image (as returned by sift.read_features_from_file()).
+            The clusters are trained on at most nbr_train descriptors. """
+
+        desc = vstack([sift.normalize_descriptors(d) for d in desclist])
+        image = concatenate([full(len(d),i,'int32') for i,d in enumerate(desclist)])
+        feature = concatenate([arange(len(d),dtype='int32') for d in desclist])
+
+        # cluster the descriptors, use unit length centers so that
+        # assignment and queries both use the largest dot product
+        if nbr_lists is None:
+            nbr_lists = int(sqrt(len(desc)))
+        nbr_lists = int(clip(nbr_lists,1,len(desc)))
+        rng = random.default_rng(seed)
+        train = desc[rng.permutation(len(desc))[:nbr_train]]
+        centroids = kmeans2(train,nbr_lists,iter=iter,minit='points',seed=seed)[0]
+        centroids = sift.normalize_descriptors(centroids)
+        labels = assign(desc,centroids)
+
+        # sort by cluster to get contiguous inverted lists
+        order = argsort(labels,kind='stable')
+        offsets = concatenate(([0],cumsum(bincount(labels,minlength=nbr_lists))))
+
+        return DescriptorIndex(centroids,ascontiguousarray(desc[order]),
+                               image[order],feature[order],offsets)
+
+    def save(self,path):
+        """ Save the index as .npy files in the directory path. """
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self.files:
+            save(os.path.join(path,name+'.npy'),getattr(self,name))
+
+    @staticmethod
+    def load(path,mmap_mode='r'):
+        """ Load an index saved with save(). The arrays are
+            memory-mapped unless mmap_mode is None. """
+
+        return DescriptorIndex(*[load(os.path.join(path,name+'.npy'),mmap_mode=mmap_mode)
+                                 for name in DescriptorIndex.files])
+
+    def query(self,desc,nprobe=8):
+        """ Find the two nearest neighbors of each descriptor. nprobe is
+            the number of clusters searched, more clusters give better
+            recall at the cost of speed. Returns rows of the index (n*2)
+            and dot products (n*2), -2 where no neighbor was found. """
+
+        q = sift.normalize_descriptors(desc)
+        nprobe = int(clip(nprobe,1,len(self.centroids)))
+
+        best_indx = zeros((len(q),2),'int')
+        best_vals = -2*ones((len(q),2),float32)
+
+        # closest clusters for each query
+        scores = dot(q,self.centroids.T)
+        probe = argpartition(-scores,nprobe-1,axis=1)[:,:nprobe]
+
+        # group the queries by cluster so each cluster is visited once
+        flat = probe.ravel()
+        order = argsort(flat,kind='stable')
+        cells = flat[order]
+        queries = order // nprobe
+        bounds = searchsorted(cells,arange(len(self.centroids)+1))
+
+        for c in unique(cells):
+            lo,hi = self.offsets[c],self.offsets[c+1]
+            if hi == lo:
+                continue
+            qs = queries[bounds[c]:bounds[c+1]]
+            dotprods = dot(q[qs],asarray(self.desc[lo:hi]).T)
+
+            # merge with the best two found so far
+            pos,vals = sift.top_two(hstack((best_vals[qs],dotprods)))
+            best_indx[qs] = where(pos < 2,take_along_axis(best_indx[qs],minimum(pos,1),axis=1),
+                                  lo + pos - 2)
+            best_vals[qs] = vals
+
+        return best_indx,best_vals
+
+    def match(self,desc,dist_ratio=0.6,nprobe=8):
+        """ For each descriptor, select its match in the indexed images
+            using the same ratio test as sift.match(). Returns image
+            and feature numbers, -1 where there is no match. """
+
+        indx,vals = self.query(desc,nprobe)
+
+        # need two neighbors for the ratio test
+        ok = vals[:,1] > -2
+        ok[ok] = sift.ratio_test(vals[ok],dist_ratio)
+
+        image = -ones(len(indx),'int')
+        feature = -ones(len(indx),'int')
+        image[ok] = self.image[indx[ok,0]]
+        feature[ok] = self.feature[indx[ok,0]]
+        return image,feature
+
+
+def assign(desc,centroids,block_size=4096):
+    """ Return the closest (largest dot product) centroid for
+        each normalized descriptor. """
+
+    labels = zeros(len(desc),'int')
+    for start in range(0,len(desc),block_size):
+        labels[start:start+block_size] = dot(desc[start:start+block_size],
+                                             centroids.T).argmax(axis=1)
+    return labels
+
+
+def recall_at_2(index,desc,nprobe=8,block_size=1024):
+    """ Fraction of the exact two nearest neighbors (brute force over
+        all indexed descriptors, as in sift.match()) that the index
+        also returns with the given nprobe. """
+
+    q = sift.normalize_descriptors(desc)
+    indx = index.query(q,nprobe)[0]
+
+    found = 0
+    desct = asarray(index.desc).T
+    for start in range(0,len(q),block_size):
+        exact = sift.top_two(dot(q[start:start+block_size],desct))[0]
+        approx = indx[start:start+block_size]
+        found += sum(exact[:,:,newaxis] == approx[:,newaxis,:])
+
+    return found / float(2*len(q))
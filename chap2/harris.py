@@ -1,5 +1,6 @@
 from pylab import *
 from numpy import *
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.ndimage import filters
 
 def compute_harris_response(im,sigma=3):
@@ -24,36 +25,165 @@ def compute_harris_response(im,sigma=3):
    return Wdet / Wtr
 
 
-def get_harris_points(harrisim,min_dist=10,threshold=0.1):
+def get_harris_points(harrisim,min_dist=10,threshold=0.1,
+                      max_corners=None,grid=None):
   """ Harris応答画像からコーナーを返す。
-     min_distはコーナーや画像境界から分離する最小ピクセル数 """
+     min_distはコーナーや画像境界から分離する最小ピクセル数。
+     max_cornersを指定すると応答の強い順に最大その数だけ返す。
+     grid=(行数,列数)を指定すると画像をセルに分割し、
+     各セルから max_corners/セル数 個までを選んでコーナーを均等に分布させる。
+     gridにはmax_cornersの指定が必要。
+     出力は応答の強い順に並んだ (N,2) の整数配列 """
+
+  if grid is not None and max_corners is None:
+    raise ValueError("grid requires max_corners.")
 
   # 閾値thresholdを超えるコーナー候補を見つける
   corner_threshold = harrisim.max() * threshold
-  harrisim_t = (harrisim > corner_threshold) * 1
-
-  # 候補の座標を得る
-  coords = array(harrisim_t.nonzero()).T
-
-  # 候補の値を得る
-  candidate_values = [harrisim[c[0],c[1]] for c in coords]
-
-  # 候補をソートする
-  index = argsort(candidate_values)
 
-  # 許容する点の座標を配列に格納する
-  allowed_locations = zeros(harrisim.shape)
-  allowed_locations[min_dist:-min_dist,min_dist:-min_dist] = 1
-
-  # 最小距離を考慮しながら、最良の点を得る
-  filtered_coords = []
-  for i in index:
-    if allowed_locations[coords[i,0],coords[i,1]] == 1:
-      filtered_coords.append(coords[i])
-      allowed_locations[(coords[i,0]-min_dist):(coords[i,0]+min_dist),
-          (coords[i,1]-min_dist):(coords[i,1]+min_dist)] = 0
-
-  return filtered_coords
+  # 近傍 2*min_dist+1 の中で最大になる点だけを残す（非最大値抑制）
+  local_max = filters.maximum_filter(harrisim,size=2*min_dist+1)
+  is_corner = (harrisim == local_max) & (harrisim > corner_threshold)
+
+  # 画像境界から min_dist 以内の点は使わない
+  is_corner[:min_dist] = False
+  is_corner[:,:min_dist] = False
+  if min_dist > 0:
+    is_corner[-min_dist:] = False
+    is_corner[:,-min_dist:] = False
+
+  # 候補の座標と値を得て、応答の強い順に並べる
+  coords = array(is_corner.nonzero()).T
+  values = harrisim[is_corner]
+  index = argsort(-values,kind='stable')
+  coords = coords[index]
+
+  # グリッドの各セルから強い順に一定数だけ選ぶ
+  if grid is not None:
+    rows,cols = grid
+    cell = ((coords[:,0] * rows // harrisim.shape[0]) * cols +
+            coords[:,1] * cols // harrisim.shape[1])
+    order = argsort(cell,kind='stable') # セル内では強い順のまま
+    first = searchsorted(cell[order],cell[order])
+    rank = empty(len(cell),'int')
+    rank[order] = arange(len(cell)) - first
+    per_cell = -(-max_corners // (rows*cols))
+    coords = coords[rank < per_cell]
+
+  if max_corners is not None:
+    coords = coords[:max_corners]
+
+  return coords
+
+
+class GaussianPyramid(object):
+  """ ガウシアンピラミッド。各オクターブに nbr_scales+3 枚の平滑化画像を持ち、
+      オクターブごとに画像を1/2に縮小する。Harris応答やDoGは
+      一度計算したらキャッシュし、検出と記述子の計算で共有する。 """
+
+  def __init__(self,im,sigma0=1.6,nbr_scales=3,min_size=16):
+    self.sigma0 = sigma0
+    self.nbr_scales = nbr_scales
+    self.cache = {}
+
+    # 元画像のぼけを0.5と仮定して最初のレベルを作る
+    k = 2**(1.0/nbr_scales)
+    base = filters.gaussian_filter(asarray(im,float32),sqrt(sigma0**2-0.25))
+
+    # 各レベルは1つ前のレベルを追加で平滑化して求める
+    self.octaves = []
+    while min(base.shape) >= min_size:
+      levels = [base]
+      for i in range(1,nbr_scales+3):
+        sigma = sigma0*k**(i-1)
+        levels.append(filters.gaussian_filter(levels[-1],sigma*sqrt(k**2-1)))
+      self.octaves.append(array(levels))
+      base = levels[nbr_scales][::2,::2]
+
+  def sigma(self,o,s):
+    """ オクターブo、レベルsの元画像でのスケール """
+    return self.sigma0 * 2**(o + s/float(self.nbr_scales))
+
+  def level(self,scales):
+    """ スケールに最も近い検出用のレベル(1...nbr_scales)の
+        オクターブとレベルを返す """
+    t = around(log2(asarray(scales)/self.sigma0)*self.nbr_scales).astype(int)
+    o = clip((t-1)//self.nbr_scales,0,len(self.octaves)-1)
+    return o,t - o*self.nbr_scales
+
+  def harris(self,o):
+    """ オクターブoの各レベルのスケール正規化したHarris応答 """
+    if ('harris',o) not in self.cache:
+      response = zeros(self.octaves[o].shape,float32)
+      for s,im in enumerate(self.octaves[o]):
+        # 平滑化済みの画像なので微分は差分で求める
+        imy,imx = gradient(im)
+        sigma = self.sigma0 * 2**(s/float(self.nbr_scales))
+        Wxx = filters.gaussian_filter(imx*imx,sigma)
+        Wxy = filters.gaussian_filter(imx*imy,sigma)
+        Wyy = filters.gaussian_filter(imy*imy,sigma)
+        response[s] = sigma**2 * (Wxx*Wyy - Wxy**2) / (Wxx + Wyy + 1e-12)
+      self.cache['harris',o] = response
+    return self.cache['harris',o]
+
+  def dog(self,o):
+    """ オクターブoのDifference-of-Gaussians（スケール正規化したラプラシアンの近似）"""
+    if ('dog',o) not in self.cache:
+      self.cache['dog',o] = self.octaves[o][1:] - self.octaves[o][:-1]
+    return self.cache['dog',o]
+
+
+def get_harris_laplace_points(pyramid,min_dist=3,threshold=0.1,max_corners=None):
+  """ Harris-Laplace検出器。各スケールでHarris応答の極大点を求め、
+      DoGの絶対値がそのスケールで極大になる点だけを残す（特性スケール）。
+      min_distは各オクターブの解像度での最小ピクセル数。
+      出力：元画像でのコーナーの座標 (N,2) とスケール (N,)。応答の強い順 """
+
+  S = pyramid.nbr_scales
+  responses = [pyramid.harris(o) for o in range(len(pyramid.octaves))]
+  corner_threshold = threshold * amax([r[1:S+1].max() for r in responses])
+
+  coords = []
+  scales = []
+  values = []
+  for o,response in enumerate(responses):
+    dog = abs(pyramid.dog(o))
+    for s in range(1,S+1):
+      h = response[s]
+
+      # 空間方向の非最大値抑制
+      local_max = filters.maximum_filter(h,size=2*min_dist+1)
+      is_corner = (h == local_max) & (h > corner_threshold)
+      is_corner[:min_dist] = False
+      is_corner[:,:min_dist] = False
+      if min_dist > 0:
+        is_corner[-min_dist:] = False
+        is_corner[:,-min_dist:] = False
+
+      # スケール方向にラプラシアンが極大になる点
+      is_corner &= (dog[s] > dog[s-1]) & (dog[s] >= dog[s+1])
+
+      coords.append(array(is_corner.nonzero()).T * 2**o)
+      scales.append(full(is_corner.sum(),pyramid.sigma(o,s)))
+      values.append(h[is_corner])
+
+  coords = concatenate(coords).astype(int)
+  scales = concatenate(scales)
+  index = argsort(-concatenate(values),kind='stable')[:max_corners]
+
+  return coords[index],scales[index]
+
+
+def get_pyramid_descriptors(pyramid,coords,scales,wid=5):
+  """ 各コーナーについて、特性スケールのレベルの画像から
+      幅 2*wid+1 の近傍ピクセル値を返す（get_descriptors()と同じ形式）"""
+
+  o,s = pyramid.level(scales)
+  desc = zeros((len(coords),(2*wid+1)**2),float32)
+  for oo,ss in set(zip(o,s)):
+    ndx = ((o == oo) & (s == ss)).nonzero()[0]
+    desc[ndx] = get_descriptors(pyramid.octaves[oo][ss],coords[ndx] // 2**oo,wid)
+  return desc
 
 
 def plot_harris_points(image,filtered_coords):
@@ -68,49 +198,80 @@ def plot_harris_points(image,filtered_coords):
 
 def get_descriptors(image,filtered_coords,wid=5):
   """ 各点について、点の周辺で幅 2*wid+1 の近傍ピクセル値を返す。
-      （点の最小距離 min_distance > wid を仮定する）"""
-  desc = []
-  for coords in filtered_coords:
-    patch = image[coords[0]-wid:coords[0]+wid+1,
-                  coords[1]-wid:coords[1]+wid+1].flatten() 
-    desc.append(patch)
-
-  return desc
-
-
-def match(desc1,desc2,threshold=0.5):
+      画像境界に近い点は境界のピクセル値で埋めて切り出す。
+      出力は (点の数, (2*wid+1)**2) の配列 """
+
+  # 境界を拡張した画像のスライディングウィンドウ（コピーなしのビュー）
+  padded = pad(image,wid,mode='edge')
+  windows = sliding_window_view(padded,(2*wid+1,2*wid+1))
+
+  # 全ての点のパッチを一度に取り出す
+  coords = array(filtered_coords,'int').reshape(-1,2)
+  patches = windows[coords[:,0],coords[:,1]]
+
+  return patches.reshape(len(coords),(2*wid+1)**2)
+
+
+def normalize_patches(desc):
+  """ 記述子（パッチ）を平均0・標準偏差1に正規化し、
+      float32の連続した(N,D)行列として返す。 """
+  desc = array(desc, dtype=float32)
+  desc -= desc.mean(axis=1, keepdims=True)
+  s = desc.std(axis=1, keepdims=True)
+  s[s == 0] = inf # 一様なパッチは相関0にする
+  desc /= s
+  return ascontiguousarray(desc)
+
+
+def ncc_matches(desc1,desc2,threshold=0.5,block_size=1024):
+  """ 正規化相互相関の行列から双方向の最良の対応を求める。
+      スコア行列はblock_size行ずつ行列積で計算するので、
+      メモリ使用量は block_size*len(desc2) に抑えられる。
+      出力： matches_12（desc1の各点に対するdesc2の対応）、
+         matches_21（desc2の各点に対するdesc1の対応）。対応なしは-1 """
+  d1 = normalize_patches(desc1)
+  d2 = normalize_patches(desc2)
+  n = d1.shape[1]
+  d2t = d2.T / (n-1) # 転置とNCCの分母を事前に計算しておく
+
+  matches_12 = -ones(len(d1),'int')
+  matches_21 = -ones(len(d2),'int')
+  best_21 = -ones(len(d2),float32)
+  for start in range(0,len(d1),block_size):
+    ncc = dot(d1[start:start+block_size],d2t)
+    ncc[~(ncc > threshold)] = -1
+
+    # 行方向：第1の画像の各点について最良の点
+    ndx = ncc.argmax(axis=1)
+    ok = ncc[arange(len(ndx)),ndx] > threshold
+    matches_12[start:start+len(ndx)][ok] = ndx[ok]
+
+    # 列方向：これまでのブロックより良いときだけ更新する
+    ndx = ncc.argmax(axis=0)
+    val = ncc[ndx,arange(len(ndx))]
+    better = val > best_21
+    best_21[better] = val[better]
+    matches_21[better] = ndx[better] + start
+
+  return matches_12,matches_21
+
+
+def match(desc1,desc2,threshold=0.5,block_size=1024):
   """ 正規化相互相関を用いて、第1の画像の各コーナー点記述子について、
-      第2の画像の対応点を選択する。"""
-  n = len(desc1[0])
-
-  # 対応点ごとの距離
-  d = -ones((len(desc1),len(desc2)))
-  for i in range(len(desc1)):
-    for j in range(len(desc2)):
-      d1 = (desc1[i] - mean(desc1[i])) / std(desc1[i])
-      d2 = (desc2[j] - mean(desc2[j])) / std(desc2[j])
-      ncc_value = sum(d1 * d2) / (n-1)
-      if ncc_value > threshold:
-        d[i,j] = ncc_value
+      第2の画像の対応点を選択する。対応がない点は-1になる。"""
 
-  ndx = argsort(-d)
-  matchscores = ndx[:,0]
+  return ncc_matches(desc1,desc2,threshold,block_size)[0]
 
-  return matchscores
 
+def match_twosided(desc1,desc2,threshold=0.5,block_size=1024):
+  """ match()の双方向で一致を調べるバージョン。
+      スコア行列は一度だけ計算して両方向で共有する。 """
 
-def match_twosided(desc1,desc2,threshold=0.5):
-  """ match()の双方向で一致を調べるバージョン """
-
-  matches_12 = match(desc1,desc2,threshold)
-  matches_21 = match(desc2,desc1,threshold)
-
-  ndx_12 = where(matches_12 >= 0)[0]
+  matches_12,matches_21 = ncc_matches(desc1,desc2,threshold,block_size)
 
   # 非対称の場合を除去する
-  for n in ndx_12:
-    if matches_21[matches_12[n]] != n:
-      matches_12[n] = -1
+  ndx_12 = where(matches_12 >= 0)[0]
+  matches_12[ndx_12[matches_21[matches_12[ndx_12]] != ndx_12]] = -1
 
   return matches_12
 
@@ -1,35 +1,417 @@
 from PIL import Image
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from numpy import *
 from pylab import *
+from scipy import ndimage
+from scipy.spatial import cKDTree
 
 
 def process_image(imagename,resultname,params="--edge-thresh 10 --peak-thresh 5"):
-    """ Process an image and save the results in a file. """
+    """ Process an image and save the results in a file. 
+        Features are computed in process with extract_features(), 
+        params takes the --edge-thresh and --peak-thresh options
+        of the sift command line program. 
+        Note that the thresholds are not on VLFeat's scale: peak_thresh 
+        is applied to the Difference-of-Gaussians of the 0...255 image 
+        and the scale space is built differently, so the same options 
+        give about 1/3 of the keypoints of the sift program (948 vs 3161 
+        for sf_view1.jpg). A lower --peak-thresh (e.g. 2) gives more, 
+        but no single value matches VLFeat on every image. """
 
-    if imagename[-3:] != 'pgm':
-        # create a pgm file
-        im = Image.open(imagename).convert('L')
-        im.save('tmp.pgm')
-        imagename = 'tmp.pgm'
-
-    cmmd = str("sift "+imagename+" --output="+resultname+
-                " "+params)
-    os.system(cmmd)
+    im = array(Image.open(imagename).convert('L'))
+    locs,desc = extract_features(im,**parse_params(params))
+    write_features_to_file(resultname,locs,desc)
     print('processed', imagename, 'to', resultname)
 
 
+def process_images(imlist,cachedir='features',params="--edge-thresh 10 --peak-thresh 5",
+                   processes=None):
+    """ Process a list of images (e.g. from imtools.get_imlist()) and return 
+        the list of feature files in the same order. Results are cached in 
+        cachedir under a hash of the image contents, params and 
+        EXTRACTOR_VERSION, only images 
+        not in the cache are processed, in parallel with processes workers. """
+    
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    
+    featlist = [os.path.join(cachedir,feature_cache_key(imname,params)+'.sift')
+                for imname in imlist]
+    
+    # one job per missing feature file (identical images share a file)
+    todo = {}
+    for imname,featname in zip(imlist,featlist):
+        if featname not in todo and not os.path.exists(featname):
+            todo[featname] = imname
+    
+    if len(todo) > 0:
+        if processes == 1 or len(todo) == 1:
+            for featname,imname in todo.items():
+                cache_features(imname,featname,params)
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                list(pool.map(cache_features,todo.values(),todo.keys(),
+                              [params]*len(todo)))
+    
+    return featlist
+
+
+def feature_cache_key(imagename,params):
+    """ Hash of the image file contents, the extraction parameters, 
+        the extractor version and the feature file format. """
+    
+    h = hashlib.sha1(EXTRACTOR_VERSION.encode() + FEATURE_MAGIC)
+    h.update(repr(sorted(parse_params(params).items())).encode())
+    with open(imagename,'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20),b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_features(imagename,resultname,params):
+    """ Process an image into a temporary file and move it in place, 
+        so that a feature file in the cache is always complete. """
+    
+    tmpname = '%s.%d.tmp' % (resultname,os.getpid())
+    process_image(imagename,tmpname,params)
+    os.replace(tmpname,resultname)
+
+
+def parse_params(params):
+    """ Convert sift command line options to 
+        keyword arguments for extract_features(). 
+        Only --edge-thresh and --peak-thresh are supported, 
+        other options raise ValueError. """
+    
+    names = {'--edge-thresh':'edge_thresh','--peak-thresh':'peak_thresh'}
+    opts = params.replace('=',' ').split()
+    if len(opts) % 2 != 0:
+        raise ValueError('missing value in sift options: %s' % params)
+    kwargs = {}
+    for name,value in zip(opts[::2],opts[1::2]):
+        if name not in names:
+            raise ValueError('unsupported sift option: %s' % name)
+        kwargs[names[name]] = float(value)
+    return kwargs
+
+
+# part of the feature cache key, change it whenever extract_features() 
+# gives different results so that cached features are recomputed
+EXTRACTOR_VERSION = 'dog-sift-1'
+
+
+def extract_features(im,peak_thresh=5,edge_thresh=10,nbr_scales=3,sigma0=1.6):
+    """ Detect Difference-of-Gaussians keypoints and compute 128-d SIFT 
+        descriptors. input: im (grayscale image as array, values 0...255).
+        Returns locs (x, y, scale, orientation of each feature) and 
+        desc (n*128, uint8) in the same layout as read_features_from_file(). """
+    
+    im = asarray(im,float32)
+    if im.ndim == 3:
+        im = im.mean(axis=2)
+    
+    k = 2**(1.0/nbr_scales)
+    nbr_octaves = int(log2(min(im.shape))) - 3
+    
+    # initial smoothing, assume the camera blur is 0.5
+    base = ndimage.gaussian_filter(im,sqrt(sigma0**2 - 0.25))
+    
+    locs = []
+    desc = []
+    for o in range(max(nbr_octaves,1)):
+        # Gaussian scale space for this octave, each level 
+        # is computed incrementally from the previous one
+        gauss = [base]
+        for i in range(1,nbr_scales+3):
+            sigma = sigma0*k**(i-1)
+            gauss.append(ndimage.gaussian_filter(gauss[-1],sigma*sqrt(k**2-1)))
+        gauss = array(gauss)
+        dog = gauss[1:] - gauss[:-1]
+        
+        level,rows,cols,offset = find_dog_extrema(dog,peak_thresh,edge_thresh)
+        
+        for s in range(1,nbr_scales+1):
+            ndx = (level == s).nonzero()[0]
+            if len(ndx) == 0:
+                continue
+            
+            # gradients of the Gaussian image at this scale
+            gy,gx = gradient(gauss[s])
+            mag = sqrt(gx**2 + gy**2)
+            ang = arctan2(gy,gx)
+            
+            sigma = sigma0*k**s
+            kp,theta = orientations(mag,ang,rows[ndx],cols[ndx],sigma)
+            ndx = ndx[kp]
+            
+            # locations in the original image
+            scale = 2**o
+            locs.append(column_stack(((cols[ndx] + offset[ndx,2])*scale,
+                                      (rows[ndx] + offset[ndx,1])*scale,
+                                      sigma0*k**(s + offset[ndx,0])*scale,
+                                      theta)))
+            desc.append(descriptors(mag,ang,rows[ndx],cols[ndx],theta,sigma))
+        
+        # next octave starts from twice the base scale
+        base = gauss[nbr_scales][::2,::2]
+        if min(base.shape) < 8:
+            break
+    
+    if len(locs) == 0:
+        return zeros((0,4),float32),zeros((0,128),uint8)
+    return vstack(locs).astype(float32),vstack(desc)
+
+
+def find_dog_extrema(dog,peak_thresh,edge_thresh):
+    """ Find local extrema in a Difference-of-Gaussians stack 
+        (levels*rows*cols) with one step of sub-pixel refinement. 
+        Low contrast points and points on edges are removed. 
+        Returns level, row, col and offset (n*3) of each extremum. """
+    
+    # extrema in the 3*3*3 neighborhood
+    is_max = dog == ndimage.maximum_filter(dog,size=3)
+    is_min = dog == ndimage.minimum_filter(dog,size=3)
+    ext = (is_max | is_min) & (abs(dog) > 0.8*peak_thresh)
+    ext[[0,-1]] = False
+    ext[:,[0,-1]] = False
+    ext[:,:,[0,-1]] = False
+    s,r,c = ext.nonzero()
+    
+    # derivatives with finite differences
+    v = dog[s,r,c]
+    g = column_stack(((dog[s+1,r,c] - dog[s-1,r,c])/2,
+                      (dog[s,r+1,c] - dog[s,r-1,c])/2,
+                      (dog[s,r,c+1] - dog[s,r,c-1])/2))
+    dss = dog[s+1,r,c] + dog[s-1,r,c] - 2*v
+    drr = dog[s,r+1,c] + dog[s,r-1,c] - 2*v
+    dcc = dog[s,r,c+1] + dog[s,r,c-1] - 2*v
+    dsr = (dog[s+1,r+1,c] - dog[s+1,r-1,c] - dog[s-1,r+1,c] + dog[s-1,r-1,c])/4
+    dsc = (dog[s+1,r,c+1] - dog[s+1,r,c-1] - dog[s-1,r,c+1] + dog[s-1,r,c-1])/4
+    drc = (dog[s,r+1,c+1] - dog[s,r+1,c-1] - dog[s,r-1,c+1] + dog[s,r-1,c-1])/4
+    H = stack((column_stack((dss,dsr,dsc)),
+               column_stack((dsr,drr,drc)),
+               column_stack((dsc,drc,dcc))),axis=1)
+    
+    # sub-pixel offset, drop points that move more than one sample
+    ok = linalg.det(H) != 0
+    offset = zeros((len(v),3),float32)
+    offset[ok] = -linalg.solve(H[ok],g[ok,:,newaxis])[:,:,0]
+    ok &= all(abs(offset) < 1,axis=1)
+    
+    # contrast at the refined position
+    ok &= abs(v + 0.5*sum(g*offset,axis=1)) >= peak_thresh
+    
+    # ratio of principal curvatures
+    tr = drr + dcc
+    det = drr*dcc - drc**2
+    ok &= (det > 0) & (tr**2*edge_thresh < (edge_thresh + 1)**2*det)
+    
+    return s[ok],r[ok],c[ok],offset[ok]
+
+
+def orientations(mag,ang,rows,cols,sigma,nbr_bins=36):
+    """ Dominant gradient orientations for keypoints at (rows,cols). 
+        Keypoints with several strong orientations are repeated.
+        Returns keypoint index and orientation (in radians). """
+    
+    # Gaussian weighted window
+    sigma_w = 1.5*sigma
+    r = int(round(3*sigma_w))
+    dy,dx = mgrid[-r:r+1,-r:r+1]
+    weight = exp(-(dx**2 + dy**2)/(2*sigma_w**2)).ravel()
+    
+    # zero padding gives no contribution outside the image
+    magp = pad(mag,r)
+    angp = pad(ang,r)
+    win_r = rows[:,newaxis] + r + dy.ravel()
+    win_c = cols[:,newaxis] + r + dx.ravel()
+    
+    # orientation histogram for each keypoint
+    bins = (floor(nbr_bins*(angp[win_r,win_c] + pi)/(2*pi)).astype(int)) % nbr_bins
+    bins += nbr_bins*arange(len(rows))[:,newaxis]
+    hist = bincount(bins.ravel(),(magp[win_r,win_c]*weight).ravel(),
+                    minlength=nbr_bins*len(rows)).reshape(len(rows),nbr_bins)
+    
+    # smooth the circular histogram
+    for i in range(6):
+        hist = (roll(hist,1,axis=1) + hist + roll(hist,-1,axis=1))/3
+    
+    # peaks within 80% of the maximum, with parabolic interpolation
+    left = roll(hist,1,axis=1)
+    right = roll(hist,-1,axis=1)
+    peaks = (hist > left) & (hist > right) & (hist >= 0.8*hist.max(axis=1)[:,newaxis])
+    kp,b = peaks.nonzero()
+    hl,hc,hr = left[kp,b],hist[kp,b],right[kp,b]
+    b = b + 0.5 + 0.5*(hl - hr)/(hl - 2*hc + hr)
+    theta = 2*pi*b/nbr_bins - pi
+    
+    return kp,theta
+
+
+def descriptors(mag,ang,rows,cols,theta,sigma,block_size=64):
+    """ 128-d SIFT descriptors (4*4 spatial bins with 8 orientations)
+        for keypoints at (rows,cols) with orientation theta. """
+    
+    # samples inside the rotated descriptor window
+    hw = 3*sigma # width of a spatial bin
+    r = int(round(hw*sqrt(2)*2.5))
+    dy,dx = mgrid[-r:r+1,-r:r+1]
+    inside = dx**2 + dy**2 <= r**2
+    dy = dy[inside]
+    dx = dx[inside]
+    magp = pad(mag,r)
+    angp = pad(ang,r)
+    
+    hist = zeros((len(rows),128))
+    for start in range(0,len(rows),block_size):
+        end = start + block_size
+        n = len(rows[start:end])
+        c = cos(theta[start:end])[:,newaxis]
+        s = sin(theta[start:end])[:,newaxis]
+        win_r = rows[start:end,newaxis] + r + dy
+        win_c = cols[start:end,newaxis] + r + dx
+        
+        # sample positions in the keypoint frame in units of bins,
+        # and gradient orientation relative to the keypoint
+        x = (c*dx + s*dy)/hw + 1.5
+        y = (-s*dx + c*dy)/hw + 1.5
+        o = ((angp[win_r,win_c] - theta[start:end,newaxis]) % (2*pi))*8/(2*pi)
+        w = magp[win_r,win_c]*exp(-((x - 1.5)**2 + (y - 1.5)**2)/8)
+        
+        # trilinear interpolation into the 4*4*8 histogram
+        x0,y0,o0 = floor(x),floor(y),floor(o)
+        fx,fy,fo = x - x0,y - y0,o - o0
+        x0,y0,o0 = x0.astype(int),y0.astype(int),o0.astype(int)
+        offset = 128*arange(n)[:,newaxis]
+        block = zeros(n*128)
+        for i in (0,1):
+            for j in (0,1):
+                xi,yi = x0 + i,y0 + j
+                valid = (xi >= 0) & (xi < 4) & (yi >= 0) & (yi < 4)
+                wxy = w*(fx if i else 1 - fx)*(fy if j else 1 - fy)
+                for l in (0,1):
+                    indx = offset + (yi*4 + xi)*8 + (o0 + l) % 8
+                    wt = wxy*(fo if l else 1 - fo)
+                    block += bincount(indx[valid],wt[valid],minlength=n*128)
+        hist[start:end] = block.reshape(n,128)
+    
+    # normalize, clip large values and renormalize
+    hist /= maximum(linalg.norm(hist,axis=1,keepdims=True),1e-12)
+    hist = minimum(hist,0.2)
+    hist /= maximum(linalg.norm(hist,axis=1,keepdims=True),1e-12)
+    return minimum(512*hist,255).astype(uint8)
+
+
+# binary feature file: a 32 byte header followed by the locations
+# (float32, n*4) and the descriptors (uint8 or float32, n*dim)
+FEATURE_MAGIC = b'PCVSIFT1'
+feature_header = dtype([('magic','S8'),('nbr','<u4'),('dim','<u4'),
+                        ('desc_type','<u4'),('reserved','<u4',(3,))])
+desc_types = [dtype('u1'),dtype('<f4')]
+
+
+def is_binary_feature_file(filename):
+    """ Check if a feature file is in the binary format. """
+    
+    with open(filename,'rb') as f:
+        return f.read(len(FEATURE_MAGIC)) == FEATURE_MAGIC
+
+
+def read_feature_header(filename):
+    """ Read the header of a binary feature file. """
+    
+    header = fromfile(filename,dtype=feature_header,count=1)[0]
+    if header['magic'] != FEATURE_MAGIC:
+        raise ValueError('not a binary feature file: '+filename)
+    return header
+
+
 def read_features_from_file(filename):
-    """ Read feature properties and return in matrix form. """
+    """ Read feature properties and return in matrix form. 
+        Binary files are memory-mapped (copy-on-write), 
+        text files from the sift binary are parsed. """
+    
+    if not is_binary_feature_file(filename):
+        f = loadtxt(filename)
+        return f[:,:4],f[:,4:] # feature locations, descriptors
+    
+    header = read_feature_header(filename)
+    nbr,dim = int(header['nbr']),int(header['dim'])
+    desc_type = desc_types[header['desc_type']]
+    if nbr == 0:
+        return zeros((0,4),float32),zeros((0,dim),desc_type)
+    
+    offset = feature_header.itemsize
+    locs = memmap(filename,float32,'c',offset,(nbr,4))
+    offset += locs.nbytes
+    desc = memmap(filename,desc_type,'c',offset,(nbr,dim))
+    return locs,desc # feature locations, descriptors
+
+
+def read_locations_from_file(filename):
+    """ Read only the feature locations, without loading 
+        the descriptors from binary files. """
+    
+    if not is_binary_feature_file(filename):
+        return read_features_from_file(filename)[0]
+    
+    nbr = int(read_feature_header(filename)['nbr'])
+    if nbr == 0:
+        return zeros((0,4),float32)
+    return memmap(filename,float32,'c',feature_header.itemsize,(nbr,4))
+
+
+def write_features_to_file(filename,locs,desc,binary=True):
+    """ Save feature location and descriptor to file. 
+        Descriptors with integer values 0...255 (as from the sift binary)
+        are stored as uint8. Use binary=False for the old text format. 
+        The file is written to a temporary name and moved in place, so 
+        arrays still memory-mapped from an old version of the file 
+        (see read_features_from_file()) stay valid. """
+    
+    tmpname = '%s.%d.tmp' % (filename,os.getpid())
+    if not binary:
+        savetxt(tmpname,hstack((locs,desc)))
+        os.replace(tmpname,filename)
+        return
     
-    f = loadtxt(filename)
-    return f[:,:4],f[:,4:] # feature locations, descriptors
+    locs = asarray(locs,float32).reshape(-1,4)
+    desc = atleast_2d(asarray(desc))
+    
+    # store as uint8 if that is lossless
+    desc_type = 1
+    if desc.dtype == uint8 or (desc.size > 0 and all(desc == around(desc)) 
+                               and desc.min() >= 0 and desc.max() <= 255):
+        desc_type = 0
+    
+    header = zeros(1,feature_header)
+    header['magic'] = FEATURE_MAGIC
+    header['nbr'] = len(locs)
+    header['dim'] = desc.shape[1]
+    header['desc_type'] = desc_type
+    
+    with open(tmpname,'wb') as f:
+        header.tofile(f)
+        locs.tofile(f)
+        desc.astype(desc_types[desc_type]).tofile(f)
+    os.replace(tmpname,filename)
 
 
-def write_features_to_file(filename,locs,desc):
-    """ Save feature location and descriptor to file. """
-    savetxt(filename,hstack((locs,desc)))
+def convert_feature_files(path,ext='.sift'):
+    """ Convert all text feature files (ending with ext) in a 
+        directory to the binary format, in place. """
     
+    converted = []
+    for f in sorted(os.listdir(path)):
+        filename = os.path.join(path,f)
+        if f.endswith(ext) and not is_binary_feature_file(filename):
+            locs,desc = read_features_from_file(filename)
+            write_features_to_file(filename,locs,desc)
+            converted.append(filename)
+    return converted
+
 
 def plot_features(im,locs,circle=False):
     """ Show image with features. input: im (image as array), 
@@ -50,30 +432,78 @@ def plot_features(im,locs,circle=False):
     axis('off')
 
 
-def match(desc1,desc2):
+def normalize_descriptors(desc):
+    """ Scale each descriptor to unit length and return them
+        as a contiguous float32 matrix (one descriptor per row). """
+    
+    desc = array(desc,dtype=float32)
+    norms = linalg.norm(desc,axis=1,keepdims=True)
+    norms[norms == 0] = 1
+    desc /= norms
+    return ascontiguousarray(desc)
+
+
+def top_two(dotprods):
+    """ Return indices (n*2) and values (n*2) of the two largest
+        dot products in each row, largest first. """
+    
+    rows = arange(dotprods.shape[0])
+    
+    # largest value, then the largest with that one masked out
+    first = dotprods.argmax(axis=1)
+    vals = empty((dotprods.shape[0],2),dotprods.dtype)
+    vals[:,0] = dotprods[rows,first]
+    dotprods[rows,first] = -inf
+    second = dotprods.argmax(axis=1)
+    vals[:,1] = dotprods[rows,second]
+    dotprods[rows,first] = vals[:,0] # restore
+    return column_stack((first,second)),vals
+
+
+def top_two_columns(dotprods):
+    """ Same as top_two() for the columns. argmax() along the first 
+        axis is slow, a contiguous copy of the transpose is cheaper. """
+    
+    return top_two(ascontiguousarray(dotprods.T))
+
+
+def ratio_test(vals,dist_ratio=0.6):
+    """ Check if the nearest neighbor has angle less than dist_ratio 
+        times the second nearest. input: vals (n*2 best dot products). """
+    
+    angles = arccos(0.9999*vals)
+    return angles[:,0] < dist_ratio * angles[:,1]
+
+
+def match(desc1,desc2,dist_ratio=0.6,block_size=1024,return_ratios=False):
     """ For each descriptor in the first image, 
         select its match in the second image.
         input: desc1 (descriptors for the first image), 
-        desc2 (same for second image). """
+        desc2 (same for second image). Dot products are computed
+        block_size rows at a time to bound memory use. 
+        With return_ratios, also returns the angle ratio nearest/second 
+        nearest of each descriptor (lower is a more distinctive match). """
     
-    desc1 = array([d/linalg.norm(d) for d in desc1])
-    desc2 = array([d/linalg.norm(d) for d in desc2])
+    desc1 = normalize_descriptors(desc1)
+    desc2 = normalize_descriptors(desc2)
     
-    dist_ratio = 0.6
-    desc1_size = desc1.shape
-    
-    matchscores = zeros((desc1_size[0]),'int')
-    desc2t = desc2.T # precompute matrix transpose
-    for i in range(desc1_size[0]):
-        dotprods = dot(desc1[i,:],desc2t) # vector of dot products
-        dotprods = 0.9999*dotprods
-        # inverse cosine and sort, return index for features in second image
-        indx = argsort(arccos(dotprods))
-        
-        # check if nearest neighbor has angle less than dist_ratio times 2nd
-        if arccos(dotprods)[indx[0]] < dist_ratio * arccos(dotprods)[indx[1]]:
-            matchscores[i] = int(indx[0])
+    matchscores = zeros((desc1.shape[0]),'int')
+    ratios = ones((desc1.shape[0]))
+    if desc2.shape[0] >= 2: # else no second neighbor for the ratio test
+        desc2t = desc2.T # precompute matrix transpose
+        for start in range(0,desc1.shape[0],block_size):
+            dotprods = dot(desc1[start:start+block_size],desc2t) # matrix of dot products
+            indx,vals = top_two(dotprods)
+            
+            # keep nearest neighbors that pass the ratio test
+            ok = ratio_test(vals,dist_ratio)
+            matchscores[start:start+len(ok)][ok] = indx[ok,0]
+            if return_ratios:
+                angles = arccos(0.9999*vals)
+                ratios[start:start+len(ok)] = angles[:,0] / angles[:,1]
     
+    if return_ratios:
+        return matchscores,ratios
     return matchscores
 
 
@@ -113,18 +543,111 @@ def plot_matches(im1,im2,locs1,locs2,matchscores,show_below=True):
     axis('off')
 
 
-def match_twosided(desc1,desc2):
+def match_both(desc1,desc2,dist_ratio=0.6,block_size=1024):
+    """ Match in both directions from a single pass over the dot product
+        matrix. Rows give the matches for desc1, columns the matches
+        for desc2. Returns the same as match(desc1,desc2), match(desc2,desc1). """
+    
+    desc1 = normalize_descriptors(desc1)
+    desc2 = normalize_descriptors(desc2)
+    
+    matches_12 = zeros((desc1.shape[0]),'int')
+    matches_21 = zeros((desc2.shape[0]),'int')
+    if desc1.shape[0] < 2 or desc2.shape[0] < 2:
+        return matches_12,matches_21 # no second neighbor for the ratio test
+    
+    # two best rows found so far for each column
+    col_indx = zeros((desc2.shape[0],2),'int')
+    col_vals = -2*ones((desc2.shape[0],2),float32)
+    
+    desc2t = desc2.T # precompute matrix transpose
+    for start in range(0,desc1.shape[0],block_size):
+        dotprods = dot(desc1[start:start+block_size],desc2t) # matrix of dot products
+        
+        # forward direction, best columns for each row
+        indx,vals = top_two(dotprods)
+        ok = ratio_test(vals,dist_ratio)
+        matches_12[start:start+len(ok)][ok] = indx[ok,0]
+        
+        # backward direction, merge the two best rows of the block
+        # with the best rows so far
+        block_indx,block_vals = top_two_columns(dotprods)
+        pos,col_vals = top_two(hstack((col_vals,block_vals)))
+        col_indx = take_along_axis(hstack((col_indx,start + block_indx)),pos,axis=1)
+    
+    ok = ratio_test(col_vals,dist_ratio)
+    matches_21[ok] = col_indx[ok,0]
+    
+    return matches_12,matches_21
+
+
+def match_twosided(desc1,desc2,dist_ratio=0.6,block_size=1024):
     """ Two-sided symmetric version of match(). """
     
-    matches_12 = match(desc1,desc2)
-    matches_21 = match(desc2,desc1)
+    matches_12,matches_21 = match_both(desc1,desc2,dist_ratio,block_size)
     
     ndx_12 = matches_12.nonzero()[0]
     
     # remove matches that are not symmetric
-    for n in ndx_12:
-        if matches_21[int(matches_12[n])] != n:
-            matches_12[n] = 0
+    matches_12[ndx_12[matches_21[matches_12[ndx_12]] != ndx_12]] = 0
     
     return matches_12
 
+
+def match_guided(desc1,desc2,locs1,locs2,H,radius=10,dist_ratio=0.6,
+                 rowcol=False,inverse=False):
+    """ Match guided by a homography H (e.g. from 
+        homography.H_from_ransac()). Each descriptor in the first 
+        image is only compared with the features of the second image 
+        within radius of its projection, using the ratio test of match() 
+        among these candidates. A single candidate is tested against 
+        an orthogonal second neighbor. Returns matchscores as match(). 
+        
+        By default H maps the (x,y) coordinates locs1[:,:2] of the 
+        first image to locs2[:,:2], as read_features_from_file() 
+        returns them. Use rowcol=True if H works on (row,col) 
+        coordinates, i.e. was estimated from locations with the two 
+        columns swapped (as in the panorama notebook), and 
+        inverse=True if H maps the second image to the first (e.g. 
+        H_from_ransac(fp,tp) with fp from locs2 and tp from locs1). """
+    
+    desc1 = normalize_descriptors(desc1)
+    desc2 = normalize_descriptors(desc2)
+    matchscores = zeros((desc1.shape[0]),'int')
+    if desc1.shape[0] == 0 or desc2.shape[0] == 0:
+        return matchscores
+    
+    # bring H to (x,y) coordinates, from the first image to the second
+    if inverse:
+        H = linalg.inv(H)
+    if rowcol:
+        swap = array([[0,1,0],[1,0,0],[0,0,1]])
+        H = dot(swap,dot(H,swap))
+    
+    # project the features of the first image
+    proj = dot(H,vstack((locs1[:,:2].T,ones(len(locs1)))))
+    proj = (proj[:2] / proj[2]).T
+    valid = isfinite(proj).all(axis=1).nonzero()[0]
+    
+    # all pairs closer than radius
+    tree2 = cKDTree(locs2[:,:2])
+    pairs = cKDTree(proj[valid]).sparse_distance_matrix(tree2,radius,output_type='ndarray')
+    i = valid[pairs['i']]
+    j = pairs['j']
+    if len(i) == 0:
+        return matchscores
+    vals = sum(desc1[i]*desc2[j],axis=1)
+    
+    # sort candidates by feature, best first, and take the two best
+    order = lexsort((-vals,i))
+    i,j,vals = i[order],j[order],vals[order]
+    first = r_[True,i[1:] != i[:-1]].nonzero()[0]
+    has_second = r_[first[1:] - first[:-1],len(i) - first[-1:]] > 1
+    best_vals = zeros((len(first),2),float32)
+    best_vals[:,0] = vals[first]
+    best_vals[has_second,1] = vals[first[has_second]+1]
+    
+    ok = ratio_test(best_vals,dist_ratio)
+    matchscores[i[first[ok]]] = j[first[ok]]
+    
+    return matchscores
@@ -35,16 +35,53 @@ def alpha_for_triangle(points,m,n):
         (given in normalized homogeneous coordinates). """
     
     alpha = zeros((m,n))
-
-    # min(),max()に入る値を必ず整数になるようint()を使う
-    for i in range(int(min(points[0])),int(max(points[0]))):
-        for j in range(int(min(points[1])),int(max(points[1]))):
-            x = linalg.solve(points,[i,j,1])
-            if min(x) > 0: #all coefficients positive
-                alpha[i,j] = 1
+    
+    r0,c0,r1,c1 = triangle_box(points,m,n)
+    alpha[r0:r1,c0:c1] = inside_triangle(linalg.inv(points),r0,c0,r1,c1)
     return alpha
     
 
+def triangle_box(points,m,n):
+    """ Pixel bounding box (r0,c0,r1,c1) of a triangle 
+        (3*3, corners as columns), clipped to an (m,n) image. """
+    
+    # 範囲の端をint()で整数にし、画像の内側にクリップする
+    r0,r1 = [int(clip(int(v),0,m)) for v in (points[0].min(),points[0].max())]
+    c0,c1 = [int(clip(int(v),0,n)) for v in (points[1].min(),points[1].max())]
+    return r0,c0,r1,c1
+    
+
+def inside_triangle(P_inv,r0,c0,r1,c1):
+    """ Boolean map of the pixels in rows r0:r1, columns c0:c1 
+        that are inside a triangle, given the inverse P_inv of 
+        its corner matrix. The barycentric coordinates of all 
+        pixels come from one product with P_inv. """
+    
+    rows,cols = mgrid[r0:r1,c0:c1]
+    x = (P_inv[:,0,newaxis,newaxis]*rows + P_inv[:,1,newaxis,newaxis]*cols + 
+         P_inv[:,2,newaxis,newaxis])
+    return x.min(axis=0) > 0 #all coefficients positive
+    
+
+def triangle_index_map(points,tri,m,n):
+    """ Map of size (m,n) with the index in tri of the triangle 
+        that covers each pixel, -1 for pixels outside the mesh. 
+        points are the corners in normalized homogeneous 
+        coordinates (3*N), later triangles are on top. """
+    
+    index = -ones((m,n),'int')
+    
+    # invert the corner matrices of all triangles at once
+    P = points[:,tri].transpose(1,0,2)
+    P_inv = linalg.inv(P)
+    
+    for k in range(len(P)):
+        r0,c0,r1,c1 = triangle_box(P[k],m,n)
+        inside = inside_triangle(P_inv[k],r0,c0,r1,c1)
+        index[r0:r1,c0:c1][inside] = k
+    return index
+    
+
 def triangulate_points(x,y):
     """ Delaunay triangulation of 2D points. """
     
@@ -61,13 +98,18 @@ def plot_mesh(x,y,tri):
         plot(x[t_ext],y[t_ext],'r')
 
 
-def pw_affine(fromim,toim,fp,tp,tri):
+def pw_affine(fromim,toim,fp,tp,tri,single_pass=True):
     """ Warp triangular patches from an image.
         fromim = image to warp 
         toim = destination image
         fp = from points in hom. coordinates
         tp = to points in hom.  coordinates
-        tri = triangulation. """
+        tri = triangulation. 
+        With single_pass, all triangles are warped at once 
+        by pw_affine_remap(), else one triangle at a time. """
+    
+    if single_pass:
+        return pw_affine_remap(fromim,toim,fp,tp,tri)
                 
     im = toim.copy()
     
@@ -98,6 +140,37 @@ def pw_affine(fromim,toim,fp,tp,tri):
     return im
     
     
+def pw_affine_remap(fromim,toim,fp,tp,tri):
+    """ Warp triangular patches from an image as pw_affine() in 
+        a single pass. The affine transformations of all triangles 
+        are solved at once, each pixel of toim takes the one of its 
+        triangle from triangle_index_map() and each channel is 
+        sampled with one map_coordinates() call. 
+        fp,tp are normalized homogeneous coordinates. """
+    
+    im = toim.copy()
+    tri = asarray(tri)
+    
+    # affine transformations from tp to fp for all triangles
+    A = matmul(fp[:,tri].transpose(1,0,2),linalg.inv(tp[:,tri].transpose(1,0,2)))
+    
+    # source coordinates of all pixels inside the mesh
+    index = triangle_index_map(tp,tri,im.shape[0],im.shape[1])
+    rows,cols = (index >= 0).nonzero()
+    k = index[rows,cols]
+    coords = array([A[k,0,0]*rows + A[k,0,1]*cols + A[k,0,2],
+                    A[k,1,0]*rows + A[k,1,1]*cols + A[k,1,2]])
+    
+    if len(fromim.shape) == 3:
+        for col in range(fromim.shape[2]):
+            im[rows,cols,col] = ndimage.map_coordinates(fromim[:,:,col],coords,
+                                                        output=fromim.dtype)
+    else:
+        im[rows,cols] = ndimage.map_coordinates(fromim,coords,output=fromim.dtype)
+        
+    return im
+    
+    
 def panorama(H,fromim,toim,padding=2400,delta=2400):
     """ Create horizontal panorama by blending two images 
         using a homography H (preferably estimated using RANSAC).
@@ -107,26 +180,16 @@ def panorama(H,fromim,toim,padding=2400,delta=2400):
     # check if images are grayscale or color
     is_color = len(fromim.shape) == 3
     
-    # homography transformation for geometric_transform()
-    def transf(p):
-        p2 = dot(H,[p[0],p[1],1])
-        return (p2[0]/p2[2],p2[1]/p2[2])
-    
     if H[1,2]<0: # fromim is to the right
         print('warp - right')
         # transform fromim
         if is_color:
             # pad the destination image with zeros to the right
             toim_t = hstack((toim,zeros((toim.shape[0],padding,3))))
-            fromim_t = zeros((toim.shape[0],toim.shape[1]+padding,toim.shape[2]))
-            for col in range(3):
-                fromim_t[:,:,col] = ndimage.geometric_transform(fromim[:,:,col],
-                                        transf,(toim.shape[0],toim.shape[1]+padding))
         else:
             # pad the destination image with zeros to the right
             toim_t = hstack((toim,zeros((toim.shape[0],padding))))
-            fromim_t = ndimage.geometric_transform(fromim,transf,
-                                    (toim.shape[0],toim.shape[1]+padding)) 
+        fromim_t = warp_homography(fromim,H,(toim.shape[0],toim.shape[1]+padding))
     else:
         print('warp - left')
         # add translation to compensate for padding to the left
@@ -136,20 +199,15 @@ def panorama(H,fromim,toim,padding=2400,delta=2400):
         if is_color:
             # pad the destination image with zeros to the left
             toim_t = hstack((zeros((toim.shape[0],padding,3)),toim))
-            fromim_t = zeros((toim.shape[0],toim.shape[1]+padding,toim.shape[2]))
-            for col in range(3):
-                fromim_t[:,:,col] = ndimage.geometric_transform(fromim[:,:,col],
-                                            transf,(toim.shape[0],toim.shape[1]+padding))
         else:
             # pad the destination image with zeros to the left
             toim_t = hstack((zeros((toim.shape[0],padding)),toim))
-            fromim_t = ndimage.geometric_transform(fromim,
-                                    transf,(toim.shape[0],toim.shape[1]+padding))
+        fromim_t = warp_homography(fromim,H,(toim.shape[0],toim.shape[1]+padding))
     
     # blend and return (put fromim above toim)
     if is_color:
         # all non black pixels
-        alpha = ((fromim_t[:,:,0] * fromim_t[:,:,1] * fromim_t[:,:,2] ) > 0)
+        alpha = (fromim_t > 0).all(axis=2)
         for col in range(3):
             toim_t[:,:,col] = fromim_t[:,:,col]*alpha + toim_t[:,:,col]*(1-alpha)
     else:
@@ -158,3 +216,156 @@ def panorama(H,fromim,toim,padding=2400,delta=2400):
     
     return toim_t
 
+
+def warp_homography(im,H,shape,order=3,offset=(0,0),prefilter=True):
+    """ Warp im with the homography H to an image of size shape 
+        (rows,cols). Output pixel (i,j) gets the value of im at 
+        H*[i+offset[0],j+offset[1],1], as with geometric_transform(), 
+        but the coordinates of all pixels come from one matrix product 
+        and each channel is sampled with a single map_coordinates() call. 
+        Use prefilter=False if im already holds spline coefficients 
+        (see ndimage.spline_filter1d()). """
+    
+    # source coordinates of all output pixels
+    rows,cols = indices(shape[:2])
+    rows += offset[0]
+    cols += offset[1]
+    p = dot(H,vstack((rows.ravel(),cols.ravel(),ones(rows.size))))
+    coords = (p[:2] / p[2]).reshape((2,)+tuple(shape[:2]))
+    
+    if len(im.shape) == 3:
+        im_t = zeros(tuple(shape[:2])+im.shape[2:],im.dtype)
+        for col in range(im.shape[2]):
+            im_t[:,:,col] = ndimage.map_coordinates(im[:,:,col],coords,
+                                        order=order,prefilter=prefilter)
+        return im_t
+    
+    return ndimage.map_coordinates(im,coords,order=order,prefilter=prefilter)
+
+
+def warped_bounds(H,shape):
+    """ Bounding box (row_min,col_min,row_max,col_max) of an image 
+        of size shape warped with the homography H (mapping output 
+        coordinates to the image, as in warp_homography()). """
+    
+    m,n = shape[:2]
+    corners = array([[0,m-1,m-1,0],[0,0,n-1,n-1],[1,1,1,1]],float)
+    p = dot(linalg.inv(H),corners)
+    
+    # all corners must be on the same side of the horizon
+    if not ((p[2] > 0).all() or (p[2] < 0).all()):
+        raise ValueError('image is not bounded under the homography')
+    p = p[:2] / p[2]
+    
+    return (int(floor(p[0].min())),int(floor(p[1].min())),
+            int(ceil(p[0].max())),int(ceil(p[1].max())))
+
+
+def warp_into(canvas,im,H,offset=(0,0),tile_size=512,order=3):
+    """ Warp im with the homography H into the uint8 image canvas, 
+        whose pixel (i,j) has coordinates (i+offset[0],j+offset[1]) 
+        for H (as in warp_homography()). Non black warped pixels 
+        replace the canvas, as in panorama(). Only the tiles of 
+        tile_size*tile_size pixels covered by im are warped. """
+    
+    # bounding box of the warped image in the canvas
+    r0,c0,r1,c1 = warped_bounds(H,im.shape)
+    # clip the box to the canvas
+    r0,c0 = int(maximum(r0-offset[0],0)),int(maximum(c0-offset[1],0))
+    r1 = int(minimum(r1-offset[0]+1,canvas.shape[0]))
+    c1 = int(minimum(c1-offset[1]+1,canvas.shape[1]))
+    
+    # spline coefficients are computed once, not for every tile
+    coeffs = array(im,float32)
+    if order > 1:
+        for axis in range(2):
+            coeffs = ndimage.spline_filter1d(coeffs,order,axis,output=float32)
+    
+    for i in range(r0,r1,tile_size):
+        for j in range(c0,c1,tile_size):
+            shape = (int(minimum(tile_size,r1-i)),int(minimum(tile_size,c1-j)))
+            im_t = warp_homography(coeffs,H,shape,order,(i+offset[0],j+offset[1]),False)
+            im_t = clip(rint(im_t),0,255)
+            
+            # all non black pixels
+            alpha = im_t > 0
+            if len(im_t.shape) == 3:
+                alpha = alpha.all(axis=2)
+            tile = canvas[i:i+shape[0],j:j+shape[1]]
+            tile[alpha] = im_t[alpha]
+    
+    return canvas
+
+
+def panorama_tiled(H,fromim,toim,tile_size=512,filename=None):
+    """ Blend two images using a homography H as panorama(), 
+        but the canvas is the exact bounding box of toim and the 
+        warped fromim, allocated once as uint8 (as a memory-mapped 
+        file if filename is given) and fromim is warped tile by 
+        tile. Returns the canvas and the coordinates of its top left 
+        pixel in toim. """
+    
+    # bounding box of both images in the coordinates of toim
+    r0,c0,r1,c1 = warped_bounds(H,fromim.shape)
+    r0,c0 = int(minimum(r0,0)),int(minimum(c0,0))
+    r1,c1 = int(maximum(r1,toim.shape[0]-1)),int(maximum(c1,toim.shape[1]-1))
+    
+    shape = (r1-r0+1,c1-c0+1) + toim.shape[2:]
+    if filename is None:
+        canvas = zeros(shape,'uint8')
+    else:
+        canvas = memmap(filename,dtype='uint8',mode='w+',shape=shape)
+    
+    # put fromim above toim
+    canvas[-r0:toim.shape[0]-r0,-c0:toim.shape[1]-c0] = clip(toim,0,255)
+    warp_into(canvas,fromim,H,(r0,c0),tile_size)
+    
+    return canvas,(r0,c0)
+
+
+def chain_homographies(Hs,ref):
+    """ Homographies mapping coordinates of image ref to each 
+        image, from Hs where Hs[i] maps image i+1 to image i 
+        (as H_from_ransac() with fp in image i+1, tp in image i). """
+    
+    T = [None]*(len(Hs)+1)
+    T[ref] = eye(3)
+    for i in range(ref-1,-1,-1):
+        T[i] = dot(Hs[i],T[i+1])
+    for i in range(ref+1,len(T)):
+        T[i] = dot(linalg.inv(Hs[i-1]),T[i-1])
+    
+    return [H / H[2,2] for H in T]
+
+
+def stitch(ims,Hs,ref=None,tile_size=512,filename=None):
+    """ Stitch the images ims into one panorama. Hs are the 
+        homographies between neighbors (see chain_homographies()), 
+        ref the image whose coordinates are kept (default the 
+        middle one). The uint8 canvas (memory-mapped if filename is 
+        given) is allocated once and each image is warped once 
+        with warp_into(), starting from ref and going outwards so 
+        that images further out are on top, as when chaining 
+        panorama(). Returns the canvas and the coordinates of its 
+        top left pixel in image ref. """
+    
+    if ref is None:
+        ref = len(ims)//2
+    T = chain_homographies(Hs,ref)
+    
+    # bounding box of all warped images
+    bounds = array([warped_bounds(H,im.shape) for H,im in zip(T,ims)])
+    r0,c0 = bounds[:,:2].min(axis=0)
+    r1,c1 = bounds[:,2:].max(axis=0)
+    
+    shape = (int(r1-r0+1),int(c1-c0+1)) + ims[ref].shape[2:]
+    if filename is None:
+        canvas = zeros(shape,'uint8')
+    else:
+        canvas = memmap(filename,dtype='uint8',mode='w+',shape=shape)
+    
+    # images in order of distance from ref
+    for i in sorted(range(len(ims)),key=lambda i: abs(i-ref)):
+        warp_into(canvas,ims[i],T[i],(int(r0),int(c0)),tile_size)
+    
+    return canvas,(int(r0),int(c0))
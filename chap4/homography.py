@@ -1,3 +1,4 @@
+import itertools
 from numpy import *
 from scipy import ndimage
     
@@ -6,8 +7,9 @@ class RansacModel(object):
     """ Class for testing homography fit with ransac.py from
         http://www.scipy.org/Cookbook/RANSAC"""
     
-    def __init__(self,debug=False):
+    def __init__(self,debug=False,degenerate_tol=1e-3):
         self.debug = debug
+        self.degenerate_tol = degenerate_tol
         
     def fit(self, data):
         """ Fit homography to four selected correspondences. """
@@ -23,6 +25,13 @@ class RansacModel(object):
         # fit homography and return
         return H_from_points(fp,tp)
     
+    def fit_inliers(self, data):
+        """ Fit homography to all given correspondences 
+            (least squares, used to refit to inliers). """
+        
+        data = data.T
+        return H_from_points(data[:3],data[3:])
+    
     def get_error( self, data, H):
         """ Apply homography to all correspondences, 
             return error for each transformed point. """
@@ -42,14 +51,55 @@ class RansacModel(object):
                 
         # return error per point
         return sqrt( sum((tp-fp_transformed)**2,axis=0) )
+    
+    def fit_batch(self, data):
+        """ Fit one homography to each set of four 
+            correspondences (data is K*4*6). """
+        
+        # transpose to fit H_from_points_batch()
+        data = data.transpose(0,2,1)
+        return H_from_points_batch(data[:,:3,:4],data[:,3:,:4])
+    
+    def get_error_batch(self, data, H):
+        """ Apply K homographies to all correspondences, 
+            return error for each model and point (K*n). """
+        
+        data = data.T
+        
+        # transform fp with all homographies
+        fp_transformed = matmul(H,data[:3])
+        fp_transformed = fp_transformed / fp_transformed[:,2:]
+        
+        # return error per model and point
+        return sqrt( sum((data[3:]-fp_transformed)**2,axis=1) )
+    
+    def is_degenerate_batch(self, data):
+        """ True for each set of four correspondences (data 
+            is K*4*6) with a repeated point or three points 
+            on a line in either image, these can not give a 
+            useful homography. """
+        
+        # test the points of both images in one call
+        data = data.transpose(0,2,1)
+        points = concatenate((data[:,:3],data[:,3:]))
+        return degenerate_points(points,self.degenerate_tol).reshape(2,-1).any(axis=0)
         
 
-def H_from_ransac(fp,tp,model,maxiter=1000,match_theshold=10):
+def H_from_ransac(fp,tp,model,maxiter=1000,match_theshold=10,batch_size=100,
+                  confidence=0.999,sampler=None,msac=False,local_optimization=0,
+                  workers=1,seed=None):
     """ Robust estimation of homography H from point 
         correspondences using RANSAC (ransac.py from
         http://www.scipy.org/Cookbook/RANSAC).
         
-        input: fp,tp (3*n arrays) points in hom. coordinates. """
+        input: fp,tp (3*n arrays) points in hom. coordinates. 
+        batch_size hypotheses are fitted and scored at a time, 
+        iteration stops early at the given confidence (None to 
+        always run maxiter iterations). sampler chooses the samples
+        (e.g. ransac.ProsacSampler, default uniform). msac and 
+        local_optimization select MSAC scoring and LO-RANSAC refits. 
+        workers > 1 runs the hypotheses on that many threads, the 
+        result is reproducible for a given seed and workers. """
     
     import ransac
     
@@ -57,7 +107,11 @@ def H_from_ransac(fp,tp,model,maxiter=1000,match_theshold=10):
     data = vstack((fp,tp))
     
     # compute H and return
-    H,ransac_data = ransac.ransac(data.T,model,4,maxiter,match_theshold,10,return_all=True)
+    H,ransac_data = ransac.ransac(data.T,model,4,maxiter,match_theshold,10,return_all=True,
+                                  batch_size=batch_size,confidence=confidence,
+                                  sampler=sampler,msac=msac,
+                                  local_optimization=local_optimization,
+                                  workers=workers,seed=seed)
     return H,ransac_data['inliers']
 
 
@@ -68,41 +122,98 @@ def H_from_points(fp,tp):
     
     if fp.shape != tp.shape:
         raise RuntimeError('number of points do not match')
-        
-    # condition points (important for numerical reasons)
-    # --from points--
-    m = mean(fp[:2], axis=1)
-    maxstd = max(std(fp[:2], axis=1)) + 1e-9
-    C1 = diag([1/maxstd, 1/maxstd, 1]) 
-    C1[0][2] = -m[0]/maxstd
-    C1[1][2] = -m[1]/maxstd
-    fp = dot(C1,fp)
     
-    # --to points--
-    m = mean(tp[:2], axis=1)
-    maxstd = max(std(tp[:2], axis=1)) + 1e-9
-    C2 = diag([1/maxstd, 1/maxstd, 1])
-    C2[0][2] = -m[0]/maxstd
-    C2[1][2] = -m[1]/maxstd
-    tp = dot(C2,tp)
+    return H_from_points_batch(fp[newaxis],tp[newaxis])[0]
+
+
+def H_from_points_batch(fp,tp):
+    """ Find homographies for K sets of correspondences at once
+        (same method as H_from_points()). 
+        input: fp,tp (K*3*n arrays) points in hom. coordinates.
+        Returns a K*3*3 array of homographies. """
+    
+    if fp.shape != tp.shape:
+        raise RuntimeError('number of points do not match')
     
-    # create matrix for linear method, 2 rows for each correspondence pair
-    nbr_correspondences = fp.shape[1]
-    A = zeros((2*nbr_correspondences,9))
-    for i in range(nbr_correspondences):        
-        A[2*i] = [-fp[0][i],-fp[1][i],-1,0,0,0,
-                    tp[0][i]*fp[0][i],tp[0][i]*fp[1][i],tp[0][i]]
-        A[2*i+1] = [0,0,0,-fp[0][i],-fp[1][i],-1,
-                    tp[1][i]*fp[0][i],tp[1][i]*fp[1][i],tp[1][i]]
+    # condition points (important for numerical reasons)
+    C1 = condition_matrices(fp)
+    C2 = condition_matrices(tp)
+    fp = matmul(C1,fp)
+    tp = matmul(C2,tp)
+    
+    # create matrices for linear method, 2 rows for each correspondence pair
+    K,_,nbr_correspondences = fp.shape
+    x,y,w = fp[:,0],fp[:,1],fp[:,2]
+    u,v = tp[:,0],tp[:,1]
+    zero = zeros((K,nbr_correspondences))
+    A = zeros((K,nbr_correspondences,2,9))
+    A[:,:,0] = stack((-x,-y,-w,zero,zero,zero,u*x,u*y,u*w),axis=2)
+    A[:,:,1] = stack((zero,zero,zero,-x,-y,-w,v*x,v*y,v*w),axis=2)
+    A = A.reshape(K,2*nbr_correspondences,9)
     
+    # one stacked SVD, full_matrices so that V has 9 rows for 4 points
     U,S,V = linalg.svd(A)
-    H = V[8].reshape((3,3))    
+    H = V[:,8].reshape((K,3,3))
     
     # decondition
-    H = dot(linalg.inv(C2),dot(H,C1))
+    H = matmul(linalg.inv(C2),matmul(H,C1))
     
     # normalize and return
-    return H / H[2,2]
+    return H / H[:,2:,2:]
+
+
+def degenerate_points(points,tol=1e-3,all_collinear=False):
+    """ Test K sets of points (K*3*n array, hom. coordinates) 
+        for degeneracy. A set is degenerate if two points are 
+        closer than tol times its size (largest distance 
+        between two points) or if a triple of points is on a 
+        line, that is its determinant (twice the triangle 
+        area) is below tol times the size squared. With 
+        all_collinear only sets where all triples are on a 
+        line are degenerate. Returns a boolean array (K). """
+    
+    x = points[:,0] / points[:,2]
+    y = points[:,1] / points[:,2]
+    pairs,triples = point_subsets(points.shape[2])
+    
+    # spacing of all pairs
+    i,j = pairs
+    dist = sqrt((x[:,i]-x[:,j])**2 + (y[:,i]-y[:,j])**2)
+    size = dist.max(axis=1)
+    
+    # determinants of all triples
+    i,j,k = triples
+    det = abs((x[:,j]-x[:,i])*(y[:,k]-y[:,i]) - (y[:,j]-y[:,i])*(x[:,k]-x[:,i]))
+    det = det.max(axis=1) if all_collinear else det.min(axis=1)
+    
+    return (dist.min(axis=1) <= tol*size) | (det <= tol*size**2)
+
+
+# pairs and triples of n points, computed once for each n
+_subsets = {}
+
+def point_subsets(n):
+    """ Index arrays of all pairs (2*n(n-1)/2) and 
+        triples (3*...) of n points. """
+    
+    if n not in _subsets:
+        _subsets[n] = (array(triu_indices(n,1)),
+                       array(list(itertools.combinations(range(n),3))).T)
+    return _subsets[n]
+
+
+def condition_matrices(points):
+    """ Conditioning matrices for K sets of points (K*3*n), 
+        zero mean and max standard deviation one. """
+    
+    m = mean(points[:,:2],axis=2)
+    maxstd = std(points[:,:2],axis=2).max(axis=1) + 1e-9
+    C = zeros((len(points),3,3))
+    C[:,0,0] = C[:,1,1] = 1/maxstd
+    C[:,0,2] = -m[:,0]/maxstd
+    C[:,1,2] = -m[:,1]/maxstd
+    C[:,2,2] = 1
+    return C
 
 
 def Haffine_from_points(fp,tp):
@@ -1,3 +1,7 @@
+import copy
+import concurrent.futures
+import json
+import time
 import numpy
 import scipy # use numpy if scipy unavailable
 import scipy.linalg # use numpy if scipy unavailable
@@ -32,7 +36,9 @@ import scipy.linalg # use numpy if scipy unavailable
 ## (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 ## OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-def ransac(data,model,n,k,t,d,debug=False,return_all=False):
+def ransac(data,model,n,k,t,d,debug=False,return_all=False,batch_size=None,
+           confidence=None,sampler=None,sprt=None,msac=False,local_optimization=0,
+           workers=1,seed=None,max_redraws=10,stats=False):
     """fit model parameters to data using the RANSAC algorithm
     
 This implementation written from pseudocode found at
@@ -73,42 +79,453 @@ while iterations < k {
 }
 return bestfit
 }}}
+
+If batch_size is given and the model has fit_batch() and get_error_batch()
+(see LinearLeastSquaresModel), hypotheses are fitted and scored batch_size
+at a time with one array operation. Acceptance and refit are unchanged.
+
+If confidence is given (e.g. 0.99), iteration stops as soon as a sample
+without outliers has been drawn with that probability, estimated from the
+largest consensus set found so far. k is still the maximum number of
+iterations. The number of iterations used is returned as
+ransac_data['iterations'].
+
+sampler chooses the minimal samples, it has a method sample(n,n_data,nbr,rng)
+returning nbr*n indices (see UniformSampler, ProsacSampler and
+NapsacSampler). The default is UniformSampler.
+
+If sprt is True (or an SPRT instance), each hypothesis is scored on a
+growing random subset of the data and dropped as soon as Wald's sequential
+probability ratio test decides it is bad, so most bad hypotheses are
+rejected after a few dozen residuals. The number of residuals computed is
+returned as ransac_data['evaluations'].
+
+If the model has a method is_degenerate_batch(data) taking K samples
+(K*n*cols) and returning a boolean array, degenerate samples (e.g.
+collinear points) are redrawn before any fit, up to max_redraws times.
+The number of samples rejected this way is returned as
+ransac_data['degenerate'].
+
+If msac is True, models are ranked by the truncated quadratic cost
+sum(min(err,t)**2) over all data (MSAC) instead of the mean error of the
+refit set, and the inliers are all rows with err < t under the final model.
+A model whose get_error() is already squared (e.g. the Sampson distance)
+sets squared_error = True, its cost is sum(min(err,t)).
+MSAC refits use model.fit_inliers() if the model has it, a least squares
+fit to all given rows, since fit() may only use the first n rows. The mean
+error ranking keeps fit(), a least squares refit would let small sets win.
+local_optimization > 0 (implies msac) runs that many refits inside the
+inlier set whenever a hypothesis beats the best model so far, with the
+inlier threshold going down from 2*t to t (LO-RANSAC).
+
+workers > 1 splits the iterations over that many threads (numpy releases
+the GIL in the fits and residuals). Each worker draws from its own random
+stream spawned from seed and gets its own copy of sampler and sprt. The
+workers run in rounds of batch_size hypotheses each, after every round the
+best model, the best cost and the iteration limit are shared in worker
+order, so the result depends only on seed and workers and not on thread
+timing. With a seed the result is also reproducible for workers=1,
+without one the global numpy.random state is used.
+
+If stats is True, a RansacStats with counts, timings and the inlier count
+after each round is returned as ransac_data['stats'].
 """
+    if seed is None and workers == 1:
+        rngs = [numpy.random]
+    else:
+        rngs = [numpy.random.RandomState(numpy.random.MT19937(s))
+                for s in numpy.random.SeedSequence(seed).spawn(workers)]
+    if sampler is None:
+        sampler = UniformSampler()
+    if sprt is True:
+        sprt = SPRT()
+    searches = []
+    for rng in rngs:
+        # workers > 1 must not share the state of the sampler and the test
+        searches.append(RansacSearch(data,model,n,t,d,batch_size,
+            sampler if workers == 1 else copy.copy(sampler),
+            sprt if workers == 1 or not sprt else copy.copy(sprt),
+            msac,local_optimization,rng,max_redraws,stats,debug))
+    round_size = batch_size or 1
+
     iterations = 0
     bestfit = None
     besterr = numpy.inf
     best_inlier_idxs = None
-    while iterations < k:
-        maybe_idxs, test_idxs = random_partition(n,data.shape[0])
-        maybeinliers = data[maybe_idxs,:]
-        test_points = data[test_idxs]
-        maybemodel = model.fit(maybeinliers)
-        test_err = model.get_error( test_points, maybemodel)
-        also_idxs = test_idxs[test_err < t] # select indices of rows with accepted points
-        alsoinliers = data[also_idxs,:]
-        if debug:
-            print('test_err.min()',test_err.min())
-            print('test_err.max()',test_err.max())
-            print('numpy.mean(test_err)',numpy.mean(test_err))
-            print('iteration %d:len(alsoinliers) = %d'%(
-                iterations,len(alsoinliers)))
-        if len(alsoinliers) > d:
-            betterdata = numpy.concatenate( (maybeinliers, alsoinliers) )
-            bettermodel = model.fit(betterdata)
-            better_errs = model.get_error( betterdata, bettermodel)
-            thiserr = numpy.mean( better_errs )
-            if thiserr < besterr:
-                bestfit = bettermodel
-                besterr = thiserr
-                best_inlier_idxs = numpy.concatenate( (maybe_idxs, also_idxs) )
-        iterations+=1
+    max_iterations = k
+    best_consensus = 0
+    best_iteration = None
+    inlier_curve = []
+    start_time = time.perf_counter()
+    pool = None
+    if workers > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(workers)
+    try:
+        while iterations < max_iterations:
+            remaining = max_iterations - iterations
+            quotas = [int(min(round_size,max(0,remaining-w*round_size)))
+                      for w in range(workers)]
+            starts = [iterations+w*round_size for w in range(workers)]
+            if pool is None:
+                searches[0].run(quotas[0],starts[0])
+            else:
+                list(pool.map(RansacSearch.run,searches,quotas,starts))
+            iterations += sum(quotas)
+
+            # merge in worker order, the first of equal models wins
+            consensus = 0
+            for search in searches:
+                if search.besterr < besterr:
+                    bestfit = search.bestfit
+                    besterr = search.besterr
+                    best_inlier_idxs = search.best_inlier_idxs
+                    best_iteration = search.best_iteration
+                consensus = max(consensus,search.consensus)
+            for search in searches:
+                search.besterr = besterr
+                if search.sprt:
+                    search.sprt.update_epsilon(consensus/float(data.shape[0]))
+            if stats:
+                inlier_curve.append((iterations,0 if best_inlier_idxs is None
+                                     else len(best_inlier_idxs)))
+            if confidence is not None:
+                if consensus > best_consensus:
+                    best_consensus = consensus
+                    max_iterations = min(max_iterations,required_iterations(
+                        best_consensus/float(data.shape[0]),n,confidence))
+                # samplers that do not sample uniformly can stop earlier
+                if best_inlier_idxs is not None and hasattr(sampler,'required_iterations'):
+                    max_iterations = min(max_iterations,workers*min(
+                        search.sampler.required_iterations(best_inlier_idxs,n,confidence)
+                        for search in searches))
+    finally:
+        if pool is not None:
+            pool.shutdown()
     if bestfit is None:
         raise ValueError("did not meet fit acceptance criteria")
     if return_all:
-        return bestfit, {'inliers':best_inlier_idxs}
+        ransac_data = {'inliers':best_inlier_idxs,'iterations':iterations,
+                       'evaluations':sum(search.evaluations for search in searches),
+                       'degenerate':sum(search.degenerate for search in searches)}
+        if stats:
+            ransac_data['stats'] = RansacStats(iterations,ransac_data['degenerate'],
+                ransac_data['evaluations'],best_iteration,inlier_curve,
+                time.perf_counter()-start_time,workers,[search.times for search in searches])
+        return bestfit, ransac_data
     else:
         return bestfit
 
+class RansacSearch:
+    """the hypotheses of one RANSAC worker, drawn with its own random
+    stream rng. run() continues the search for a number of hypotheses,
+    ransac() reads and shares the best model between calls."""
+    def __init__(self,data,model,n,t,d,batch_size,sampler,sprt,msac,
+                 local_optimization,rng,max_redraws=10,timed=False,debug=False):
+        self.data = data
+        self.model = model
+        self.n = n
+        self.t = t
+        self.d = d
+        self.batch_size = batch_size
+        self.batched = batch_size is not None and hasattr(model,'fit_batch')
+        self.sampler = sampler
+        self.sprt = sprt
+        self.msac = msac or local_optimization > 0
+        self.local_optimization = local_optimization
+        self.squared = getattr(model,'squared_error',False)
+        self.rng = rng
+        self.max_redraws = max_redraws
+        self.debug = debug
+        self.bestfit = None
+        self.besterr = numpy.inf
+        self.best_inlier_idxs = None
+        self.best_iteration = None
+        self.consensus = 0
+        self.evaluations = 0
+        self.degenerate = 0
+        # seconds spent in each step, only measured if timed
+        self.times = dict.fromkeys(RansacStats.steps,0.0) if timed else None
+        self.last_tick = None
+        if hasattr(sampler,'reset'):
+            sampler.reset()
+        # order in which the data is scored, random for the SPRT
+        if sprt:
+            self.order = rng.permutation(data.shape[0])
+            self.blocks = sprt.blocks(data.shape[0])
+        else:
+            self.order = numpy.arange(data.shape[0])
+            self.blocks = [0,data.shape[0]]
+    def run(self,nbr_hypotheses,first_iteration=0):
+        data,model,n,t,d = self.data,self.model,self.n,self.t,self.d
+        done = 0
+        while done < nbr_hypotheses:
+            self.tick()
+            nbr = int(min(self.batch_size if self.batched else 1,nbr_hypotheses-done))
+            maybe_idxs = self.sampler.sample(n,data.shape[0],nbr,self.rng)
+            if hasattr(model,'is_degenerate_batch'):
+                maybe_idxs = self.redraw_degenerate(maybe_idxs)
+            self.tick('sample')
+            if self.batched:
+                maybemodels = model.fit_batch(data[maybe_idxs])
+            else:
+                maybemodels = [model.fit(data[maybe_idxs[0]])]
+            self.tick('fit')
+            test_errs,nbr_errs = score_hypotheses(data,model,maybemodels,maybe_idxs,t,
+                self.batched,self.order,self.blocks,self.sprt)
+            self.tick('score')
+            self.evaluations += nbr_errs
+            accepted = test_errs < t
+            nbr_also = accepted.sum(axis=1)
+            for i in range(nbr):
+                if self.debug:
+                    print('iteration %d:len(alsoinliers) = %d'%(
+                        first_iteration+done+i,nbr_also[i]))
+                if nbr_also[i] > d and self.msac:
+                    # refit only hypotheses that beat the best model so far
+                    if msac_cost(test_errs[i],t,self.squared) >= self.besterr:
+                        continue
+                    betterdata = data[numpy.concatenate( (maybe_idxs[i], accepted[i].nonzero()[0]) )]
+                    bettermodel = refit(model,betterdata)
+                    better_errs = model.get_error( data, bettermodel)
+                    thiserr = msac_cost(better_errs,t,self.squared)
+                    bettermodel,better_errs,thiserr = local_optimize(data,model,n,t,
+                        bettermodel,better_errs,thiserr,self.local_optimization)
+                    if thiserr < self.besterr:
+                        self.bestfit = bettermodel
+                        self.besterr = thiserr
+                        self.best_inlier_idxs = (better_errs < t).nonzero()[0]
+                        self.best_iteration = first_iteration+done+i
+                elif nbr_also[i] > d:
+                    also_idxs = accepted[i].nonzero()[0]
+                    betterdata = data[numpy.concatenate( (maybe_idxs[i], also_idxs) )]
+                    bettermodel = model.fit(betterdata)
+                    better_errs = model.get_error( betterdata, bettermodel)
+                    thiserr = numpy.mean( better_errs )
+                    if thiserr < self.besterr:
+                        self.bestfit = bettermodel
+                        self.besterr = thiserr
+                        self.best_inlier_idxs = numpy.concatenate( (maybe_idxs[i], also_idxs) )
+                        self.best_iteration = first_iteration+done+i
+            self.tick('refit')
+            done += nbr
+            self.consensus = max(self.consensus,n + nbr_also.max())
+            if self.best_inlier_idxs is not None:
+                self.consensus = max(self.consensus,len(self.best_inlier_idxs))
+            if self.sprt:
+                self.sprt.update_epsilon((n + nbr_also.max())/float(data.shape[0]))
+    def tick(self,step=None):
+        """add the time since the last tick to times[step]"""
+        if self.times is None:
+            return
+        now = time.perf_counter()
+        if step is not None:
+            self.times[step] += now - self.last_tick
+        self.last_tick = now
+    def redraw_degenerate(self,maybe_idxs):
+        """replace the samples the model finds degenerate, samples that
+        are still degenerate after max_redraws draws are kept"""
+        bad = self.model.is_degenerate_batch(self.data[maybe_idxs])
+        for i in range(self.max_redraws):
+            nbr_bad = int(bad.sum())
+            if nbr_bad == 0:
+                break
+            self.degenerate += nbr_bad
+            maybe_idxs[bad] = self.sampler.sample(self.n,self.data.shape[0],nbr_bad,self.rng)
+            bad[bad] = self.model.is_degenerate_batch(self.data[maybe_idxs[bad]])
+        return maybe_idxs
+
+class RansacStats:
+    """statistics of one ransac() run (with stats=True)
+
+    hypotheses is the number of hypotheses tried, degenerate the number of
+    samples redrawn, evaluations the number of residuals computed and
+    best_iteration the iteration that found the returned model.
+    inlier_curve holds (iterations, inliers of the best model) after each
+    round of batch_size hypotheses. times has the seconds spent sampling,
+    fitting, scoring and refitting, summed over the workers, and
+    total_time the wall clock time of the run.
+    """
+    steps = ['sample','fit','score','refit']
+    def __init__(self,hypotheses,degenerate,evaluations,best_iteration,
+                 inlier_curve,total_time,workers,worker_times):
+        self.hypotheses = int(hypotheses)
+        self.degenerate = int(degenerate)
+        self.evaluations = int(evaluations)
+        self.best_iteration = None if best_iteration is None else int(best_iteration)
+        self.inlier_curve = [(int(i),int(m)) for i,m in inlier_curve]
+        self.total_time = total_time
+        self.workers = workers
+        self.times = dict((step,sum(times[step] for times in worker_times))
+                          for step in self.steps)
+    def as_dict(self):
+        return {'hypotheses':self.hypotheses,'degenerate':self.degenerate,
+                'evaluations':self.evaluations,'best_iteration':self.best_iteration,
+                'inlier_curve':[list(point) for point in self.inlier_curve],
+                'total_time':self.total_time,'workers':self.workers,
+                'times':dict(self.times)}
+    def to_json(self,filename=None):
+        """the statistics as a JSON string, also written to filename if given"""
+        text = json.dumps(self.as_dict(),indent=2)
+        if filename is not None:
+            with open(filename,'w') as f:
+                f.write(text)
+        return text
+
+def msac_cost(errs,t,squared=False):
+    """truncated quadratic cost, errors above t (or nan) cost t**2, or t
+    if the errors are squared already"""
+    if squared:
+        return numpy.sum(numpy.fmin(errs,t))
+    return numpy.sum(numpy.fmin(errs,t)**2)
+
+def refit(model,data):
+    """fit model to all rows of data, with fit_inliers() if the model has
+    it (fit() of a minimal solver may only use the first n rows)"""
+    if hasattr(model,'fit_inliers'):
+        return model.fit_inliers(data)
+    return model.fit(data)
+
+def local_optimize(data,model,n,t,fit,errs,cost,steps):
+    """refit to the inliers of the best model steps times, with the inlier
+    threshold going down from 2*t to t (from 4*t for squared errors), keep
+    the fit with the lowest cost"""
+    squared = getattr(model,'squared_error',False)
+    for i in range(steps):
+        t_i = t*(1 + (steps-1-i)/float(steps))**(2 if squared else 1)
+        idxs = (errs < t_i).nonzero()[0]
+        if len(idxs) < n:
+            break
+        newfit = refit(model,data[idxs])
+        newerrs = model.get_error(data,newfit)
+        newcost = msac_cost(newerrs,t,squared)
+        if newcost < cost:
+            fit,errs,cost = newfit,newerrs,newcost
+    return fit,errs,cost
+
+def score_hypotheses(data,model,maybemodels,maybe_idxs,t,batched,order,blocks,sprt):
+    """errors of all data rows for each hypothesis (nbr*n_data), infinite for
+    the sample points and for hypotheses rejected by the SPRT. The rows are
+    scored in the given order, block by block. Also returns the number of
+    errors computed."""
+    nbr = len(maybe_idxs)
+    test_errs = numpy.empty((nbr,data.shape[0]))
+    test_errs.fill(numpy.inf)
+    position = numpy.empty(len(order),int)
+    position[order] = numpy.arange(len(order))
+    sample_pos = position[maybe_idxs]
+    alive = numpy.arange(nbr)
+    nbr_consistent = numpy.zeros(nbr,int)
+    nbr_errs = 0
+    for lo,hi in zip(blocks[:-1],blocks[1:]):
+        rows = order[lo:hi]
+        if batched:
+            errs = model.get_error_batch(data[rows],maybemodels[alive])
+        else:
+            errs = numpy.array([model.get_error(data[rows],maybemodels[i]) for i in alive])
+        nbr_errs += errs.size
+        # the sample points are not test points
+        i,j = ((sample_pos[alive] >= lo) & (sample_pos[alive] < hi)).nonzero()
+        errs[i,sample_pos[alive][i,j]-lo] = numpy.inf
+        test_errs[alive[:,None],rows] = errs
+        if sprt and hi < data.shape[0]:
+            nbr_consistent[alive] += (errs < t).sum(axis=1)
+            reject = sprt.reject(nbr_consistent[alive],hi)
+            sprt.update_delta(nbr_consistent[alive[reject]]/float(hi))
+            test_errs[alive[reject]] = numpy.inf
+            alive = alive[~reject]
+            if len(alive) == 0:
+                break
+    return test_errs,nbr_errs
+
+class SPRT:
+    """Wald's sequential probability ratio test for RANSAC hypotheses
+    (R-RANSAC with SPRT, Matas and Chum 2005)
+
+    A hypothesis is rejected when the likelihood ratio of "bad model"
+    (a point is consistent with probability delta) against "good model"
+    (probability epsilon) exceeds the threshold A. epsilon is updated from
+    the best consensus set and delta from the rejected hypotheses. A
+    depends on fit_cost, the cost of fitting one hypothesis measured in
+    residual evaluations. Residuals are evaluated in blocks starting with
+    first_block rows and doubling in size.
+    """
+    def __init__(self,epsilon=0.1,delta=0.01,fit_cost=200,first_block=16):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.fit_cost = fit_cost
+        self.first_block = first_block
+        self.nbr_rejected = 0
+        self.update_threshold()
+    def blocks(self,n_data):
+        """bounds of the blocks of rows scored between tests"""
+        bounds = [0]
+        size = self.first_block
+        while bounds[-1] < n_data:
+            bounds.append(min(bounds[-1]+size,n_data))
+            size *= 2
+        return bounds
+    def update_threshold(self):
+        """decision threshold A (iterated as in Matas and Chum)"""
+        if self.epsilon <= self.delta:
+            self.log_A = numpy.inf # the test can not tell models apart
+            return
+        C = ((1-self.delta)*numpy.log((1-self.delta)/(1-self.epsilon)) +
+             self.delta*numpy.log(self.delta/self.epsilon))
+        A = self.fit_cost*C + 1
+        for i in range(10):
+            A = self.fit_cost*C + 1 + numpy.log(A)
+        self.log_A = numpy.log(A)
+    def reject(self,nbr_consistent,nbr_points):
+        """True for hypotheses that are bad with nbr_consistent
+        of nbr_points consistent"""
+        log_lambda = (nbr_consistent*numpy.log(self.delta/self.epsilon) +
+                      (nbr_points-nbr_consistent)*numpy.log((1-self.delta)/(1-self.epsilon)))
+        return log_lambda > self.log_A
+    def update_epsilon(self,inlier_ratio):
+        """epsilon from the largest consensus set so far"""
+        if inlier_ratio > self.epsilon:
+            self.epsilon = min(inlier_ratio,0.999)
+            self.update_threshold()
+    def update_delta(self,consistent_ratios):
+        """delta as the mean consistent ratio of rejected hypotheses"""
+        if len(consistent_ratios) == 0:
+            return
+        total = self.delta*self.nbr_rejected + numpy.sum(consistent_ratios)
+        self.nbr_rejected += len(consistent_ratios)
+        self.delta = min(max(total/self.nbr_rejected,1e-4),0.999)
+        self.update_threshold()
+
+def required_iterations(inlier_ratio,n,confidence):
+    """number of iterations needed to draw at least one sample of n inliers
+    with probability confidence"""
+    return samples_needed(inlier_ratio**n,confidence)
+
+def samples_needed(p_good,confidence):
+    """number of samples needed to draw at least one good sample with
+    probability confidence, when each sample is good with probability p_good"""
+    if p_good >= 1:
+        return 1
+    if p_good <= 0:
+        return numpy.inf
+    return numpy.ceil(numpy.log(1-confidence)/numpy.log1p(-p_good))
+
+def random_samples(n,n_data,nbr,rng=numpy.random):
+    """return nbr sets of n distinct random rows (nbr*n array of indices),
+    row i is drawn from range(n_data[i]) if n_data is an array. rng is
+    numpy.random or a numpy.random.RandomState"""
+    sizes = numpy.broadcast_to(n_data,(nbr,))[:,None]
+    if nbr > 0 and sizes.min() < n:
+        raise ValueError("not enough data to draw %d distinct rows"%n)
+    idxs = (rng.random((nbr,n))*sizes).astype(int)
+    # redraw the samples that contain a row twice
+    while n > 1:
+        sorted_idxs = numpy.sort(idxs,axis=1)
+        dup = (sorted_idxs[:,1:] == sorted_idxs[:,:-1]).any(axis=1)
+        if not dup.any():
+            break
+        idxs[dup] = (rng.random((dup.sum(),n))*sizes[dup]).astype(int)
+    return idxs
+
 def random_partition(n,n_data):
     """return n random rows of data (and also the other len(data)-n rows)"""
     all_idxs = numpy.arange( n_data )
@@ -117,6 +534,115 @@ def random_partition(n,n_data):
     idxs2 = all_idxs[n:]
     return idxs1, idxs2
 
+class UniformSampler:
+    """uniform random samples, without shuffling all the data"""
+    def sample(self,n,n_data,nbr,rng=numpy.random):
+        return random_samples(n,n_data,nbr,rng)
+
+class ProsacSampler:
+    """progressive sampling (PROSAC, Chum and Matas 2005)
+
+    Samples are drawn from a subset of the best scored data that grows
+    with the number of samples drawn, so good models are found early
+    while the sampling becomes uniform in the end. scores has one value
+    per data row, lower is better (e.g. the ratios from sift.match()).
+    max_samples is the number of samples after which PROSAC is uniform.
+
+    required_iterations() only stops early on subsets of at least
+    min_prefix rows (default 20*n) whose inliers pass the non-randomness
+    test: a wrong model is consistent with each row with probability beta,
+    and the inliers must be more than such a model gets with probability
+    psi. Otherwise a small top ranked subset that fits another structure
+    (or only the minimal sample) would end the search.
+    """
+    def __init__(self,scores,max_samples=200000,min_prefix=None,beta=0.05,psi=0.05):
+        self.order = numpy.argsort(scores,kind='stable')
+        self.max_samples = max_samples
+        self.min_prefix = min_prefix
+        self.beta = beta
+        self.psi = psi
+        self.reset()
+    def reset(self):
+        self.drawn = 0
+        self.m = None
+        self.reached = [] # (subset size, samples drawn before it was used)
+    def sample(self,n,n_data,nbr,rng=numpy.random):
+        if self.m is None:
+            # average number of samples from the n best rows
+            self.m = n
+            self.T_m = float(self.max_samples)
+            for i in range(n):
+                self.T_m *= (n-i)/float(n_data-i)
+            self.T_prime = 1
+            self.reached.append((self.m,0))
+        sizes = numpy.zeros(nbr,int)
+        with_last = numpy.zeros(nbr,bool)
+        for i in range(nbr):
+            self.drawn += 1
+            # grow the subset when its share of samples is used
+            if self.drawn > self.T_prime and self.m < n_data:
+                T_next = self.T_m*(self.m+1)/float(self.m+1-n)
+                self.T_prime += int(numpy.ceil(T_next - self.T_m))
+                self.T_m = T_next
+                self.m += 1
+                self.reached.append((self.m,self.drawn-1))
+            sizes[i] = self.m
+            with_last[i] = self.T_prime >= self.drawn
+        # n-1 rows from the first m-1 and row m, or n rows from the first m
+        idxs = numpy.empty((nbr,n),int)
+        idxs[~with_last] = random_samples(n,sizes[~with_last],(~with_last).sum(),rng)
+        idxs[with_last,:-1] = random_samples(n-1,sizes[with_last]-1,with_last.sum(),rng)
+        idxs[with_last,-1] = sizes[with_last]-1
+        return self.order[idxs]
+    def required_iterations(self,inlier_idxs,n,confidence):
+        """iterations needed given the inliers of the best model, using
+        the inlier ratio within each subset that has been sampled from and
+        passes the non-randomness test. The n rows of the minimal sample are
+        not counted as inliers."""
+        import scipy.stats
+        is_inlier = numpy.zeros(len(self.order),bool)
+        is_inlier[inlier_idxs] = True
+        nbr_inliers = numpy.cumsum(is_inlier[self.order])
+        min_prefix = self.min_prefix or 20*n
+        sizes = numpy.array([m for m,drawn in self.reached if m >= min_prefix],int)
+        if len(sizes) == 0:
+            return numpy.inf
+        drawn = numpy.array([drawn for m,drawn in self.reached if m >= min_prefix])
+        inliers = numpy.maximum(nbr_inliers[sizes-1] - n,0)
+        # most inliers a wrong model gets among the other m-n rows
+        random_inliers = scipy.stats.binom.isf(self.psi,sizes-n,self.beta)
+        ok = inliers > random_inliers
+        if not ok.any():
+            return numpy.inf
+        return min(d + required_iterations(i/float(m),n,confidence)
+                   for m,d,i in zip(sizes[ok],drawn[ok],inliers[ok]))
+
+class NapsacSampler:
+    """spatially local samples (NAPSAC, Myatt et al. 2002)
+
+    Each sample is a random row together with n-1 of its nbr_neighbors
+    closest rows, measured on points (n_data*dim, e.g. the image
+    coordinates of the first image). Inliers tend to be close to each
+    other, so local samples are more often free of outliers. Samples
+    from a too small neighborhood give models that only fit locally.
+
+    The default nbr_neighbors=100 only helps when the inliers are
+    clustered in the image. With outliers spread uniformly over the
+    same area (homography, 1000 points, 25% inliers) every seed ran
+    to k=5000 iterations and found only 25-77 of the 250 inliers;
+    use a larger nbr_neighbors or the default uniform sampling there.
+    """
+    def __init__(self,points,nbr_neighbors=100):
+        import scipy.spatial
+        points = numpy.asarray(points)
+        nbr_neighbors = min(nbr_neighbors,len(points)-1)
+        tree = scipy.spatial.cKDTree(points)
+        self.neighbors = tree.query(points,nbr_neighbors+1)[1][:,1:]
+    def sample(self,n,n_data,nbr,rng=numpy.random):
+        centers = rng.randint(n_data,size=nbr)
+        picks = random_samples(n-1,self.neighbors.shape[1],nbr,rng)
+        return numpy.column_stack((centers,self.neighbors[centers[:,None],picks]))
+
 class LinearLeastSquaresModel:
     """linear system solved using linear least squares
 
@@ -136,9 +662,20 @@ class LinearLeastSquaresModel:
     def get_error( self, data, model):
         A = numpy.vstack([data[:,i] for i in self.input_columns]).T
         B = numpy.vstack([data[:,i] for i in self.output_columns]).T
-        B_fit = scipy.dot(A,model)
+        B_fit = numpy.dot(A,model)
         err_per_point = numpy.sum((B-B_fit)**2,axis=1) # sum squared error per row
         return err_per_point
+    def fit_batch(self, data):
+        """fit one model per sample, data is nbr*n*columns"""
+        A = data[:,:,list(self.input_columns)]
+        B = data[:,:,list(self.output_columns)]
+        return numpy.matmul(numpy.linalg.pinv(A),B)
+    def get_error_batch( self, data, models):
+        """error of every data row for each model (nbr*n_data)"""
+        A = data[:,list(self.input_columns)]
+        B = data[:,list(self.output_columns)]
+        B_fit = numpy.matmul(A,models)
+        return numpy.sum((B-B_fit)**2,axis=2)
         
 def test():
     # generate perfect input data
@@ -148,7 +685,7 @@ def test():
     n_outputs = 1
     A_exact = 20*numpy.random.random((n_samples,n_inputs) )
     perfect_fit = 60*numpy.random.normal(size=(n_inputs,n_outputs) ) # the model
-    B_exact = scipy.dot(A_exact,perfect_fit)
+    B_exact = numpy.dot(A_exact,perfect_fit)
     assert B_exact.shape == (n_samples,n_outputs)
 
     # add a little gaussian noise (linear least squares alone should handle this well)
@@ -142,8 +142,12 @@ class RansacModel(object):
   """ ransac.py を用いて基礎行列を当てはめるためのクラス
     http://www.scipy.org/Cookbook/RANSAC """
 
-  def __init__(self,debug=False):
+  # get_error()はSampson距離（2乗の誤差）を返す
+  squared_error = True
+
+  def __init__(self,debug=False,degenerate_tol=1e-3):
     self.debug = debug
+    self.degenerate_tol = degenerate_tol
 
   def fit(self,data):
     """ 8つの選択した対応を使って基礎行列を推定する """
@@ -157,6 +161,13 @@ class RansacModel(object):
     F = compute_fundamental_normalized(x1,x2)
     return F
 
+  def fit_inliers(self,data):
+    """ 与えられたすべての対応から基礎行列を最小二乗推定する
+        （インライアへの再推定に使う） """
+
+    data = data.T
+    return compute_fundamental_normalized(data[:3],data[3:])
+
   def get_error(self,data,F):
     """ すべての対応について x^T F x を計算し、
         変換された点の誤差を返す """
@@ -170,11 +181,43 @@ class RansacModel(object):
     Fx1 = dot(F,x1)
     Fx2 = dot(F,x2)
     denom = Fx1[0]**2 + Fx1[1]**2 + Fx2[0]**2 + Fx2[1]**2
-    err = ( diag(dot(x1.T,dot(F,x2))) )**2 / denom
+    err = ( sum(x1*Fx2,axis=0) )**2 / denom
 
     # 1点あたりの誤差を返す
     return err
 
+  def fit_batch(self,data):
+    """ K組の8つの対応(K*8*6の配列)からそれぞれ基礎行列を推定する """
+
+    data = data.transpose(0,2,1)
+    return compute_fundamental_normalized_batch(data[:,:3,:8],data[:,3:,:8])
+
+  def get_error_batch(self,data,F):
+    """ K個の基礎行列それぞれについて、すべての対応の誤差(K*n)を返す """
+
+    data = data.T
+    x1 = data[:3]
+    x2 = data[3:]
+
+    # get_error()と同じSampson距離
+    Fx1 = matmul(F,x1)
+    Fx2 = matmul(F,x2)
+    denom = Fx1[:,0]**2 + Fx1[:,1]**2 + Fx2[:,0]**2 + Fx2[:,1]**2
+    return ( sum(x1*Fx2,axis=1) )**2 / denom
+
+  def is_degenerate_batch(self,data):
+    """ K組の8つの対応(K*8*6の配列)のうち、どちらかの画像で
+        同じ点を含むもの、またはすべての点が直線上にあるものをTrueとする。
+        判定はhomography.degenerate_points()を使う """
+
+    from homography import degenerate_points
+
+    # 両方の画像の点を1回で判定する
+    data = data.transpose(0,2,1)
+    points = concatenate((data[:,:3],data[:,3:]))
+    return degenerate_points(points,self.degenerate_tol,
+                             all_collinear=True).reshape(2,-1).any(axis=0)
+
 def compute_fundamental_normalized(x1,x2):
   """ 正規化8点法を使って対応点群(x1,x2:3*nの配列)
       から基礎行列を計算する。各列は次のような並びである。
@@ -206,10 +249,64 @@ def compute_fundamental_normalized(x1,x2):
   return F/F[2,2]
 
 
-def F_from_ransac(x1,x2,model,maxiter=5000,match_theshold=1e-6):
+def compute_fundamental_batch(x1,x2):
+  """ compute_fundamental()をK組の対応点群(x1,x2:K*3*nの配列)に
+      まとめて適用する。出力はK*3*3の配列 """
+
+  K,_,n = x1.shape
+  if x2.shape[2] != n:
+    raise ValueError("Number of points don't match.")
+
+  # 方程式の行列を作成する（各行は x1の成分 * x2の成分 の9通り）
+  A = (x1[:,:,newaxis,:] * x2[:,newaxis,:,:]).transpose(0,3,1,2).reshape(K,n,9)
+
+  # 線形最小2乗法で計算する
+  U,S,V = linalg.svd(A)
+  F = V[:,-1].reshape(K,3,3)
+
+  # 最後の特異値を0にして階数を2にする
+  U,S,V = linalg.svd(F)
+  S[:,2] = 0
+  return matmul(U,S[:,:,newaxis]*V)
+
+def compute_fundamental_normalized_batch(x1,x2):
+  """ compute_fundamental_normalized()をK組の対応点群
+      (x1,x2:K*3*nの配列)にまとめて適用する """
+
+  # 画像の座標を組ごとに正規化する
+  def normalize_batch(x):
+    x = x / x[:,2:]
+    m = mean(x[:,:2],axis=2)
+    S = sqrt(2) / std(x[:,:2],axis=(1,2))
+    T = zeros((len(x),3,3))
+    T[:,0,0] = T[:,1,1] = S
+    T[:,0,2] = -S*m[:,0]
+    T[:,1,2] = -S*m[:,1]
+    T[:,2,2] = 1
+    return matmul(T,x),T
+
+  x1,T1 = normalize_batch(x1)
+  x2,T2 = normalize_batch(x2)
+
+  # 正規化した座標でFを計算し、正規化を元に戻す
+  F = compute_fundamental_batch(x1,x2)
+  F = matmul(T1.transpose(0,2,1),matmul(F,T2))
+
+  return F/F[:,2:,2:]
+
+
+def F_from_ransac(x1,x2,model,maxiter=5000,match_theshold=1e-6,batch_size=100,
+                  confidence=0.999,sampler=None,msac=False,local_optimization=0,
+                  workers=1,seed=None):
   """ RANSAC(http://www.scipy.org/Cookbook/RANSAC のransac.py)
       を使って点の対応から基礎行列Fをロバスト推定する。
-      入力：x1,x2(3*n配列) 同時座標系の点群 """
+      入力：x1,x2(3*n配列) 同時座標系の点群
+      batch_size個ずつの仮説をまとめて推定・評価する。
+      信頼度confidenceに達したら打ち切る（Noneなら常にmaxiter回）。
+      samplerはサンプルの選び方（ransac.ProsacSamplerなど、既定は一様）。
+      msac、local_optimizationでMSACの評価とLO-RANSACの再推定を使う
+      workers>1ならworkers個のスレッドで仮説を評価する。
+      結果はseedとworkersが同じなら再現できる """
 
   import ransac
 
@@ -217,5 +314,8 @@ def F_from_ransac(x1,x2,model,maxiter=5000,match_theshold=1e-6):
 
   # Fを計算しインライアのインデクスといっしょに返す
   F,ransac_data = ransac.ransac(data.T,model,8,maxiter,
-                    match_theshold,20,return_all=True)
+                    match_theshold,20,return_all=True,batch_size=batch_size,
+                    confidence=confidence,sampler=sampler,msac=msac,
+                    local_optimization=local_optimization,
+                    workers=workers,seed=seed)
   return F, ransac_data['inliers']